@@ -1,82 +1,166 @@
 import numpy as np
+import os
+import re
 
+from ._regrid import Regridder, regrid, conservative_matrix, bilinear_matrix
 
-def calculate_reverse_indices(incount, full_index, sparse=False):
+
+class ReverseIndices(object):
+    """
+    The indices of the data in each bin of a grid, stored in compressed sparse row
+    (CSR) form as one flat array of data indices, sorted by bin, and the offset
+    of the start of each bin in that array. ri[bin] is a view of the indices in
+    a bin, where bin is a flat index or a tuple of grid indices.
+
+    :param offsets: start of each bin in indices, with the total length appended
+    :type offsets: numpy 1d
+
+    :param indices: index of each element of the data, sorted by bin
+    :type indices: numpy 1d
+
+    :param shape: shape of the grid
+    :type shape: tuple
+    """
+    def __init__(self, offsets, indices, shape):
+        self.offsets = offsets
+        self.indices = indices
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            index = np.ravel_multi_index(index, self.shape)
+        elif index < 0:
+            index = index + len(self)
+        return self.indices[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def counts(self):
+        """The number of elements in each bin"""
+        return np.reshape(np.diff(self.offsets), self.shape)
+
+    def to_object_array(self):
+        """
+        Returns the reverse indices as an object array, of the grid shape, of the
+        indices in each bin (None if the bin is empty) as calculate_reverse_indices
+        returned before the CSR form.
+        """
+        rii = np.empty(len(self), dtype=object)
+        for index in np.flatnonzero(np.diff(self.offsets)):
+            rii[index] = self[index]
+        return np.reshape(rii, self.shape)
+
+
+def calculate_reverse_indices(incount, full_index, sparse=False, csr=False):
     """Calculates the indices that go into each bin in a histogram
         and returns an array of values where
         ri[index] is list of indices of bins in the source data that
         are part of the [index] bin in the histogram.
+        With csr set, ri is a ReverseIndices object, otherwise it is
+        an object array of arrays.
         Called from within grid_data only.
     """
     #Two arrays to consider here
     #The count in each bin, regardless of data validity (missing data, masks, etc.)
     #called count_full, and the full_index that places every element into the output array
     
-    #We define two arrays, rii contains arrays of each for each output bin, where each
-    #array is the list of indices that go into that bin.  rjj contains 
-    
-    array_length = incount.size
+    #A single stable sort of full_index groups the indices of the elements by bin,
+    #each bin in increasing order. The offsets of each bin in the sorted indices
+    #are the cumulative counts of each bin.
     shp = incount.shape
-    #create the storage arrays
-    rii = np.empty(array_length, dtype=np.ndarray)
-    rjj = np.zeros(array_length, dtype=np.int)
-    #flatten the incount array
-    c = np.reshape(incount, incount.size)
-    #calculate the unique values and their indices, and an array that can
-    #be used to reconstruct the full_index
-    (fi_value, fi_index, fi_inverse) = \
-            np.unique(full_index, return_index=True, return_inverse=True)
-    #count the elements that go into each bin
-    bc_fi_inverse = np.bincount(fi_inverse)
-
-    #IF we're in sparse mode, then we should index into a counter array, instead of the real fi_value array    
+    full_index = np.ravel(full_index)
+    order = np.argsort(full_index, kind="stable")
     if sparse:
-        locations = np.arange(fi_value.size)
+        #in sparse mode the bins are the unique values of full_index, so count
+        #the length of each run of the same value in the sorted full_index
+        ordered = full_index[order]
+        starts = np.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+        offsets = np.concatenate([[0], starts, [ordered.size]])
     else:
-        locations= fi_value
-
-#new inversion code
-    temp = np.argsort(fi_inverse)
-    counter=0
-    for count,elem in enumerate(locations):
-        rjj[elem] = bc_fi_inverse[count]
-        rii[elem] = np.sort(temp[counter:counter+rjj[elem]])# np.where(fi_inverse==count)[0] 
-        counter=counter+rjj[elem]
-#The commented-out code should be the equivalent code, but it's slower than the where method above
-#If there are problems, change the code back to calculate the full arrays as below.
-#    #For each pair of value and its count, define an array
-#    #of the appropriate (count) size
-#    for loc, val in zip(locations, bc_fi_inverse):
-#        if val > 0:
-#            rii[loc] = np.zeros(val, dtype=int)
-#    #no that we've allocated enough room
-#    #loop through the inverse array, find its location in the main array outside
-#    #using the fi_value lookup (we could have just used full_index, but not in sparse mode)
-#
-#
-#    for count, val in enumerate(fi_inverse):
-#        #I think this can be replaced by index=locations[val] after the definition above
-#        if sparse is False:
-#            index = fi_value[val]
-#        else:
-#            index = val
-#        #rjj'th element of the riith element is set the location (count) of the value in fi_inverse, 
-#        #which is equivalent to the location in the input array
-#        rii[index][rjj[index]] = count
-#        #a counter, to know which element we should write to next.
-#        rjj[index] = rjj[index] + 1
-    #finally, reshape, and output
-    rii = np.reshape(rii, shp)
-    rjj = np.reshape(rjj, shp)
-
-    return rii, rjj
+        counts = np.bincount(full_index, minlength=incount.size)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+    ri = ReverseIndices(offsets, order, shp)
+    rjj = ri.counts
+    if csr:
+        return ri, rjj
+    return ri.to_object_array(), rjj
+
+
+def column_missing_data(missing_data, ncolumns):
+    """
+    Returns the list of missing data values of each of ncolumns data columns, from
+    None (no missing values), a single value (used for every column) or a list.
+    """
+    if missing_data is None:
+        return [None] * ncolumns
+    if np.ndim(missing_data) == 0:
+        return [missing_data] * ncolumns
+    missing_data = list(missing_data)
+    if len(missing_data) != ncolumns:
+        raise ValueError("{0} missing data values given for {1} data columns".format(
+            len(missing_data), ncolumns))
+    return missing_data
+
+
+def valid_index(weights, missing_data=None):
+    """
+    Returns the index of the valid elements of a single data column, those that
+    are not missing_data, not masked and not NaN, as a boolean array.
+    Returns a slice if all the data is valid, so that no copy is needed.
+    """
+    data = np.ma.getdata(weights)
+    valid = None
+    #if missing data is given, select everything that isn't missing
+    if missing_data is not None and not np.all(np.isnan(missing_data)):
+        valid = data != missing_data
+    #OR if the arrays are masked numpy arrays, then we perform the same analysis
+    #(mask==true -> bad data), (index=true -> good_data)
+    mask = np.ma.getmask(weights)
+    if mask is not np.ma.nomask and np.any(mask):
+        if valid is None:
+            valid = ~np.broadcast_to(mask, data.shape)
+        else:
+            valid &= ~mask
+    #NaN is always missing
+    if data.dtype.kind in "fc":
+        nan = np.isnan(data)
+        if np.any(nan):
+            if valid is None:
+                valid = ~nan
+            else:
+                valid &= ~nan
+    #OR there's no missing data, select all the data
+    if valid is None or np.all(valid):
+        return slice(None, None, None)
+    return valid
+
+
+def valid_data(weights, missing_data=None):
+    """
+    Returns the index of the valid elements of a single data column (see valid_index),
+    and the valid data as a plain numpy array, selected once for all the reductions.
+    """
+    index = valid_index(weights, missing_data)
+    return (index, np.ma.getdata(weights)[index])
 
 
 def calculate_statistics(full_index, weights,
-                         bs, square=None, sparse=False, missing_data=None):
+                         bs, square=None, sparse=False, missing_data=None,
+                         stable=True, point_weights=None):
     """
     Calculates the mean, variance,and count of each bin indexed in full_index with data coming from 
-    weights
+    weights. weights is either a single column of N values, or N*D values for D data columns,
+    in which case missing_data is a list with one entry per column, and the outputs have
+    an extra last dimension of length D. With stable set, the variance is calculated from
+    the deviations from the mean of each bin (two passes), otherwise from the sum of squares.
+    With point_weights (one weight for each of the N elements), the mean and variance
+    are weighted, and the count is the effective number of elements sum(w)**2/sum(w**2).
     """
     
     #we have two data arrays here. The first is the 'full_index' that identifies
@@ -86,127 +170,353 @@ def calculate_statistics(full_index, weights,
     #but in doing so calculates the statistics appropriately.
     
     #calculate the product of bin sizes to get the largest possible array size
-    sz = 1
-    for d in bs:
-        sz = sz * d
-    #now call numpy.unique asking for the 
+    sz = grid_size(bs)
+    #In dense mode full_index is already a valid index into the flattened
+    #output array, so every element can be binned directly (no sorting).
+    #In sparse mode call numpy.unique asking for the 
     #fi_value = values that give a unique array
-    #fi_index = the indices of the values in fi_value
     #fi_inverse = the location of each element in full_index in fi_value
     #can be used to reconstruct the full_index value OR used to bin properly later
-    (fi_value, fi_index, fi_inverse) =\
-            np.unique(full_index, return_index=True, return_inverse=True)
-    
-    #now deal with missing data if present. #If we find no real data (len(w[0])==0)
-    #then our answer is pretty simple as the result is also all zeros (for variance and count),
-    #or missing for mean.
-    if missing_data:
-        w = np.where(weights != missing_data)
-        if len(w[0]):
-            index = w[0]
-        else:
-            if sparse is False:
-                m = np.zeros(bs)
-                return (m + missing_data, m.copy(), m.copy())
-            else:
-                s = np.zeros(len(fi_value))
-                return (s + missing_data, s.copy(), s.copy())
-    #OR if the arrays are masked numpy arrays, then we perform the same analysis
-    #but ask whether the mask is
-    #just a single bool, then perform the same test as above
-    #an array of bools, then invert it to get the data selection array
-    #(mask==true -> bad data), (index=true -> good_data)
-    elif isinstance(weights, np.ma.core.MaskedArray):
-        if isinstance(weights.mask, np.bool_):
-            if not weights.mask:
-                index = slice(None, None, None)
-            else:
-                if sparse is False:
-                    m = np.zeros(bs)
-                    return (m + missing_data, m.copy(), m.copy())
-                else:
-                    s = np.zeros(len(fi_value))
-                    return (s + missing_data, s.copy(), s.copy())
-        elif isinstance(weights.mask, np.ndarray):
-            index = ~weights.mask
-    #OR there's no missing data, select all the data
+    #This is the expensive (sorting) step, so it's done once for all the data columns
+    if sparse is False:
+        fi_inverse = np.ravel(full_index)
+        nbins = sz
     else:
-        index = slice(None, None, None)
+        (fi_value, fi_inverse) =\
+                np.unique(full_index, return_inverse=True)
+        fi_inverse = np.ravel(fi_inverse)
+        nbins = fi_value.size
+
+    #treat a single column as one of D columns
+    single = np.ndim(weights) == 1
+    if single:
+        weights = weights[:, np.newaxis]
+    ncolumns = weights.shape[1]
+    missing_data = column_missing_data(missing_data, ncolumns)
+
     #for convenient later, we perform a count on all of the data, regardless of 
     #it's validity
-    count_full = np.bincount(fi_inverse[slice(None, None, None)])
-    #No calculate the count (unweighted bincount) of the valid data
+    count_full = np.bincount(fi_inverse, minlength=nbins)
+    #Now calculate the count (unweighted bincount) of the valid data
     #and the sum of the data in each bin (weighted by data)
     #and the sum of squares (weighted by data**2)
-    try:
-        count = np.bincount(fi_inverse[index])
-        su = np.bincount(fi_inverse[index], weights=weights[index])
-        var = np.bincount(fi_inverse[index], weights=weights[index] ** 2)
-    #not sure what exception I'm expecting here, anymore. 
-    except:
-        count = 0. * count_full
-        su = 0. * count_full
-        var = 0. * count_full
+    #for each column, into preallocated arrays.
+    #For the (stable) variance, the sum of squares is of the deviations from the
+    #bin mean, in a second pass, which avoids the cancellation of sum(x**2)/n-mean**2
+    #when the mean is large compared to the spread.
+    #With point weights, every sum is weighted, and the sums are divided by the
+    #total weight instead of the count. Missing (NaN) weights are zero weights.
+    if point_weights is not None:
+        point_weights = np.nan_to_num(np.asarray(point_weights, dtype=float))
+    variance = square is None
+    count = np.zeros((nbins, ncolumns))
+    m = np.zeros((nbins, ncolumns))
+    var = np.zeros((nbins, ncolumns))
+    total = count if point_weights is None else np.zeros((nbins, ncolumns))
+    for i in range(ncolumns):
+        (index, values) = valid_data(weights[:, i], missing_data[i])
+        inverse = fi_inverse[index]
+        pw = None if point_weights is None else point_weights[index]
+        if stable and variance:
+            (total[:, i], m[:, i], var[:, i]) = \
+                calculate_moments(inverse, values, nbins, weights=pw)
+        else:
+            total[:, i] = np.bincount(inverse, weights=pw, minlength=nbins)
+            square_values = values ** 2
+            if pw is not None:
+                values = values * pw
+                square_values *= pw
+            m[:, i] = np.bincount(inverse, weights=values, minlength=nbins)
+            var[:, i] = np.bincount(inverse, weights=square_values, minlength=nbins)
+        if pw is not None:
+            #the effective number of elements in each bin
+            sw2 = np.bincount(inverse, weights=pw ** 2, minlength=nbins)
+            n = sw2 != 0
+            count[n, i] = total[n, i] ** 2 / sw2[n]
+
+    #divide the sums by the counts to get means, leaving empty bins as zero
+    w = total != 0
+    v = np.zeros((nbins, ncolumns))
+    v[w] = var[w] / total[w]
+    if not (stable and variance):
+        m[w] = m[w] / total[w]
+        #if square is set, return the mean of the square, not the variance.
+        if variance:
+            v = v - m * m
+
     #if we DONT want sparse data then the array_length is product of all dimensions
-    #and the shape is given in the binsize array bs
-    #if we DO want sparse data, the array_length is the largest number in the unique inverse
-    #array fi_inverse, which seems like it should eqyal the length of fi_value
-    if sparse is False:
-        array_length = sz
-        shp = bs
-    else:
-        array_length = np.max(fi_inverse) + 1
-        shp = np.max(fi_inverse) + 1
-    #construct the output arrays
-    m = np.zeros(array_length)
-    c = np.zeros(array_length)
-    cf = np.zeros(array_length)
-    v = np.zeros(array_length)
-    w = np.where(count != 0)[0]
-
-    #for count_full we can't look for the number of valid elements, because there don't
-    #have to be any, so we copy the data immediately
+    #and the shape is given in the binsize array bs, and the forward index is the
+    #list of occupied bins.
+    #if we DO want sparse data, the array_length is the number of unique bins
+    #and the arrays are already in the right order
     if sparse is False:
-        cf[fi_value] = count_full
+        shp = list(bs)
+        forward_index = np.flatnonzero(count_full)
     else:
-        cf = count_full #no indexing -> straight copy 
-    
-    #if there is data (w.size>0) then save the data in the output, otherwise
-    #the initialization to 0 is good enough.
-    #If NOT sparse, then the indexing is stored in fi_value (where its count is 
-    #nonzero
-    #if YES sparse, then the indexing is just the locations of nonzero elements
-    #which I think is every element in w.
-    forward_index = None
-    forward_index = fi_value
-    if w.size:
-        if sparse is False:
-            index = fi_value[w]
-        else:
-            index = w
-        #divide the sums by the counts to get means, 
-        m[index] = su[w] / count[w]
-        v[index] = var[w] / count[w]
-        c[index] = count[w]
-#        cf[index] = count_full[w]
-    #if square is set, return the mean of the square, not the variance.
-    if square is None:
-        v = v - m * m
+        shp = [nbins]
+        #the full index may be a compact dtype, but the output is always int64
+        forward_index = fi_value.astype(np.int64)
+    cf = count_full.astype(float)
+
+    #If a column has no valid data at all, its mean is the missing value everywhere
+    for i in range(ncolumns):
+        if missing_data[i] is not None and not np.any(count[:, i]):
+            m[:, i] = missing_data[i]
+
+    #reshape the output to N dimensional arrays (with D as the last dimension)
+    #in sparse mode shp is just the array length.
+    if single:
+        cshp = shp
     else:
-        pass
-    #in NON sparse mode, we need to reshape the output to N dimensional arrays
-    #otherwise shp is just the array length and nothing happens here.
-    m = np.reshape(m, shp)
-    v = np.reshape(v, shp)
-    c = np.reshape(c, shp)
+        cshp = shp + [ncolumns]
+    m = np.reshape(m, cshp)
+    v = np.reshape(v, cshp)
+    c = np.reshape(count, cshp)
     cf = np.reshape(cf, shp)
     
     return (m, v, c, cf, forward_index)
 
 
+def edge_bin_index(x, edges, nbins):
+    """
+    Returns the bin index of each element of x given the monotonic bin edges,
+    clipped into the first and last (overflow) bins. This is the same index as
+    nbins - np.digitize(x, edges[::-1]), but uses a single sorted search.
+
+    :param x: the axis data to bin
+    :type x: numpy array
+
+    :param edges: monotonic bin edges
+    :type edges: numpy array
+
+    :param nbins: number of bins
+    :type nbins: int
+
+    :return: bin index of each element in x
+    :rtype: numpy int array
+    """
+    x = np.asarray(x)
+    edges = np.asarray(edges)
+    if edges[0] >= edges[-1]:
+        #for decreasing (or constant) edges, digitize is a search of the
+        #reversed, increasing, edges
+        index = nbins - np.searchsorted(edges[::-1], x, side="right")
+    else:
+        index = np.searchsorted(edges, x, side="right") + (nbins - edges.size)
+    return np.clip(index, 0, nbins - 1)
+
+
+def uniform_bin_index(x, mn, mx, nbins):
+    """
+    Returns the bin index of each element of x in nbins uniform bins between
+    mn and mx, clipped into the first and last (overflow) bins. The index is
+    calculated arithmetically, then corrected against the np.linspace edges
+    so that it is identical to edge_bin_index (and np.digitize) for elements
+    that round onto the other side of a bin edge.
+
+    :param x: the axis data to bin
+    :type x: numpy array
+
+    :param mn: lower edge of the first bin
+    :type mn: float
+
+    :param mx: upper edge of the last bin
+    :type mx: float
+
+    :param nbins: number of bins
+    :type nbins: int
+
+    :return: bin index of each element in x
+    :rtype: numpy int array
+    """
+    x = np.asarray(x)
+    edges = np.linspace(mn, mx, nbins + 1)
+    if not mx > mn:
+        return edge_bin_index(x, edges, nbins)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        index = (x - mn) * np.divide(nbins, mx - mn)
+    #fmin before fmax sends NaN to the last bin, as digitize does
+    index = np.fmax(np.fmin(np.floor(index), nbins - 1), 0).astype(int)
+    #step any index that fell on the wrong side of an edge, repeating
+    #only for the (few) elements that moved
+    check = slice(None)
+    while True:
+        xc = x[check]
+        ic = index[check]
+        down = (xc < edges[ic]) & (ic > 0)
+        up = (xc >= edges[ic + 1]) & (ic < nbins - 1)
+        moved = down | up
+        if not np.any(moved):
+            return index
+        ic = ic - down + up
+        index[check] = ic
+        check = np.flatnonzero(moved) if isinstance(check, slice) \
+            else check[moved]
+
+
+def grid_size(bs):
+    """Returns the number of bins in a grid with bs bins along each axis, as an exact integer"""
+    sz = 1
+    for d in bs:
+        sz = sz * int(d)
+    return sz
+
+
+def wrap_periodic(x, mn, mx):
+    """Returns x wrapped into the period [mn, mx), e.g. longitude or local time"""
+    return mn + np.mod(np.asarray(x) - mn, mx - mn)
+
+
+def calculate_axis_indices(data, bins, mn=None, mx=None, periodic=None):
+    """
+    Returns the number of bins along each axis, and a generator of the (int64) bin
+    index of each element of data along each axis in turn, so that only one axis
+    index array is held at a time. The arguments are as calculate_full_index.
+    """
+    #create a bin size array read for bin data
+    #if the first element is a numpy array, they should all be
+    #then I assume that each element in bins contains the upper bin edges
+    #of each dimension.
+    if type(bins[0]) == np.ndarray:
+        #if arrays are given in 'bins', assume they are bin edges
+        use_bins = bins
+        uniform = False
+        bs = [len(b) for b in use_bins]
+        pass
+    else:
+        #if non-lists (int,long,float) are given, assume they are nbins
+        #convert them to longs
+        bs = [int(b) for b in bins]
+
+        #if min or max are not given, calculate them
+        if mn is None:
+            mn = np.min(data, 0)
+        if mx is None:
+            mx = np.max(data, 0)
+        #the bins are uniform between mn and mx, so no edges are needed
+        uniform = True
+        pass
+    if periodic is None:
+        periodic = [False] * len(bs)
+    elif not uniform and any(periodic):
+        raise ValueError("periodic axes need integer bins with mn and mx")
+
+    #for each axis, calculate the index into the bin array that each element of
+    #the axis data appears in. Uniform bins are indexed arithmetically, bin edges
+    #by a sorted search. Both are equivalent to digitize on the reversed edges.
+    #We only use n-1 elements of each bin so that the overflow appears in the last
+    #bin, not in the (undefined) bin above the last defined one.
+    def axis_indices():
+        for i in range(len(bs)):
+            if uniform and periodic[i]:
+                yield uniform_bin_index(wrap_periodic(data[:, i], mn[i], mx[i]),
+                                        mn[i], mx[i], bs[i])
+            elif uniform:
+                yield uniform_bin_index(data[:, i], mn[i], mx[i], bs[i])
+            else:
+                yield edge_bin_index(data[:, i], use_bins[i], bs[i])
+    return (bs, axis_indices())
+
+
+def index_dtype(size):
+    """Returns the smallest signed integer dtype that can index size elements"""
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        if size - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError("a grid of {0} bins is too large to index, "
+                        "use grid_data_sparse instead".format(size))
+
+
+def fold_index(full_index, size, index):
+    """
+    Folds the index along the next axis, of size bins, into a flat index in place,
+    by scaling the flat index by the size of the axis and adding the index.
+    The size is multiplied as an int64, so an axis that is as long as the range of a
+    compact full_index dtype can't overflow it.
+    """
+    np.multiply(full_index, np.int64(size), out=full_index, casting="unsafe")
+    np.add(full_index, index, out=full_index, casting="unsafe")
+    return full_index
+
+
+def calculate_full_index(data, bins, mn=None, mx=None, periodic=None):
+    """
+    Calculates the index into the flattened grid of each element of data, binned
+    along the first len(bins) columns of data as in grid_data. Returns the index
+    and the size of each grid dimension. Periodic axes (with integer bins) wrap
+    around from mx to mn, instead of clipping into the first and last bins.
+    The index has the smallest integer dtype that can index the whole grid.
+
+    :param data: 2-dimensional(N,M) array of data to grid
+    :type data: numpy array
+
+    :param bins: list of bin edges (upper edge) or bin lengths for each axis in A
+    :type bins: list
+
+    :param mn: list of bin minima if the bins list contains integer number of bins
+    :type mn: list
+
+    :param mx: list of bin maxima if the bins list contains integer number of bins
+    :type mx: list
+
+    :param periodic: list of logicals to determine if each axis is periodic with period mx-mn
+    :type periodic: list
+
+    :return: full_index, the index into the flattened grid of each element
+    :return: bs, the number of bins along each axis
+    :rtype: tuple of (numpy 1d, list)
+    """
+    (bs, axis_indices) = calculate_axis_indices(data, bins, mn=mn, mx=mx,
+                                                periodic=periodic)
+    #The flat index into the grid must fit in a (64 bit) integer
+    dtype = index_dtype(grid_size(bs))
+    #Now combine the indexes into each dimension into a single index, one axis at a
+    #time, by scaling the full_index by the size of the next dimension and adding the
+    #next index. This is the same way you construct a multi-dimension array out of
+    #one dimensional data. No partial index can be larger than the final one,
+    #so the (compact) dtype can't overflow.
+    full_index = np.zeros(data.shape[0], dtype=dtype)
+    for (d, index) in zip(bs, axis_indices):
+        fold_index(full_index, d, index)
+    return (full_index, bs)
+
+
+def calculate_sparse_index(data, bins, mn=None, mx=None, periodic=None):
+    """
+    Calculates the occupied bins of a grid of any size (even one too large for a
+    64 bit flat index) and the bin of each element of data, by sorting the axis
+    indices of the elements lexicographically. The occupied bins are in the same
+    order as their flat index would be. The arguments are as calculate_full_index.
+
+    :return: inverse, the occupied bin of each element
+    :return: coords, the index along each axis of each occupied bin (nbins, A)
+    :return: bs, the number of bins along each axis
+    :rtype: tuple of (numpy 1d, numpy 2d, list)
+    """
+    (bs, axis_indices) = calculate_axis_indices(data, bins, mn=mn, mx=mx,
+                                                periodic=periodic)
+    (coords, inverse) = unique_rows(np.column_stack(list(axis_indices)))
+    return (inverse, coords, bs)
+
+
+def unique_rows(rows):
+    """
+    Returns the unique rows of a 2d integer array, in lexicographic order, and the
+    index of each row in the unique rows.
+    """
+    order = np.lexsort(rows.T[::-1])
+    ordered = rows[order]
+    change = np.any(ordered[1:] != ordered[:-1], axis=1)
+    starts = np.concatenate([[0], np.flatnonzero(change) + 1])
+    inverse = np.empty(rows.shape[0], dtype=np.int64)
+    inverse[order] = np.concatenate([[0], np.cumsum(change)])
+    return (ordered[starts], inverse)
+
+
 def grid_data(data, bins, mn=None, mx=None,
                 reverse_indices=None, square=None,
-                sparse=False, missing_data=None):
+                sparse=False, missing_data=None, stable=True, weights=None,
+                periodic=None):
     """Grids data into regular grid of bins
     data is an N*M numpy array, where:
     N is the number of data points,
@@ -223,6 +533,9 @@ def grid_data(data, bins, mn=None, mx=None,
     the indices in the data array (along the N dimension) of each
     element that contributes to every bin is stored in a variable
     length array in that bin.
+    With more than one data column (D>1) the statistics of all the columns are
+    calculated in a single pass, and the mean, variance and count have an
+    extra last dimension of length D.
     
     :param data: 2-dimensional(N,M) array of data to grid. 
             The first A columns are used as axes and require corresponding entries 
@@ -238,8 +551,8 @@ def grid_data(data, bins, mn=None, mx=None,
     :param mx: list of bin maxima if the bins list contains integer number of bins
     :type mx: list
 
-    :param reverse_indices: logical to determine if the indices that are used in each grid box are calculated
-    :type reverse_indices: bool
+    :param reverse_indices: logical to determine if the indices that are used in each grid box are calculated, or "csr" to return them as a ReverseIndices object
+    :type reverse_indices: bool or str
 
     :param square: logical to determine if the mean of the square data mean(X**2) is returned instead of variance (mean(X**2)-mean(X)**2)
     :type square: bool
@@ -250,6 +563,15 @@ def grid_data(data, bins, mn=None, mx=None,
     :param missing_data: list of missing data entries for each data array in D(better to mask arrays instead)
     :type missing_data: list
 
+    :param stable: logical to determine if the variance is calculated from deviations from the mean (two passes), instead of the sum of squares
+    :type stable: bool
+
+    :param weights: weight of each of the N elements (e.g. footprint area, quality or cos(latitude)), or a function of data returning them. The mean and variance are weighted, and the count is the effective number of elements sum(w)**2/sum(w**2)
+    :type weights: numpy 1d or function
+
+    :param periodic: list of logicals to determine if each axis wraps around from mx to mn (e.g. longitude, local time), integer bins only
+    :type periodic: list
+
 
     :return: Mean, calculated mean value of each grid box
     :return: Variance, calculated variance of each grid box (or mean of square)
@@ -257,7 +579,7 @@ def grid_data(data, bins, mn=None, mx=None,
     
     With reverse_indices=true
     
-    :return: ri, array containing a list for each gridpoint containing the index back into D of each datapoint
+    :return: ri, array containing a list for each gridpoint containing the index back into D of each datapoint (a ReverseIndices object, if reverse_indices is "csr")
     :return: rj, the length of each list in ri
     
     Types
@@ -274,121 +596,36 @@ def grid_data(data, bins, mn=None, mx=None,
     #data = The non-filterable part of the input data that is grouped by axes into bins
     
     import numpy as np
-    #get the shape of the incoming data, create a bin size array read for bin data
-    s = data.shape
-    bs = np.zeros(len(bins), dtype=np.int)
-    #if the first element is a numpy array, they should all be
-    #then I assume that each element in bins contains the upper bin edges
-    #of each dimension.
-    if type(bins[0]) == np.ndarray:
-        #if arrays are given in 'bins', assume they are bin edges
-        use_bins = bins
-        for i in range(len(bs)):
-            bs[i] = len(use_bins[i])
-            pass
-        pass
-    else:
-        #if non-lists (int,long,float) are given, assume they are nbins
-        #convert them to longs
-        bs = [int(b) for b in bins]
-
-        #if min or max are not given, calculate them
-        if mn is None:
-            mn = np.min(data, 0)
-        if mx is None:
-            mx = np.max(data, 0)
-        use_bins = []
-        for i in range(len(bs)):
-            use_bins.append(
-                np.linspace(mn[i], mx[i], bs[i] + 1)
-                )
-        pass
-
-    #now we have bin edges for each of the axes, either supplied or generated
-    #Calculate the product of the bin sizes
-    sz = 1
-    for d in bs:
-        sz = sz * d
-    #Create the index array that is the same shape as the incoming data
-    #except for one bin in the last dimension,
-    #TODO: I think the s[1]-1 dimension could be len(bs)
-    #index = np.zeros((s[0], s[1] - 1), dtype=np.int)
-    #implementing the TODO above
-    index = np.zeros((s[0], len(bs)), dtype=np.int)
-    #for each index array, call numpy.digitize on the data which calculates
-    #the index into the bin array that each element of the axis data appears in.
-    #We only use n-1 elements of each bin so that the overflow appears in the last
-    #bin, not in the (undefined) bin above the last defined one.
-    for i in range(len(bs)):
-        index[:, i] = np.clip(bs[i] - np.digitize(data[:, i],
-                            use_bins[i][::-1]),
-                            0, bs[i] - 1)
-
-    #Now we have the indexes into each dimension, combine them into a single index
-    #by scaling the full_index by the product of the prior dimensions and adding the
-    #next index. This is the same way you construct a multi-dimension array out of
-    #one dimensional data.
-    full_index = index[:, 0]
-    for i in range(1, len(bs)):
-        full_index = full_index * bs[i] + index[:, i]
+    (full_index, bs) = calculate_full_index(data, bins, mn=mn, mx=mx,
+                                            periodic=periodic)
+    if callable(weights):
+        weights = weights(data)
 
     lb = len(bins)
     r = data.shape[1] - lb
     #if there is only one 'data' row (i.e. 1 non-filterable row) then we need to
     #call the calculate_statistics function with the correct shape
-    #OR we loop through the data and call the function for each row.
+    #The statistics of every data column are calculated together, sharing
+    #the (expensive) binning of full_index.
+    #if there's no 'data' row then grid zeros, which gives the count.
+    #otherwise there must be the correct number of missing data values for the
+    #size of the data. Also acceptable is to pass in a masked array instead,
+    #with no missing data.
     if r==0:
-        (m, v, c, cf,forward_index) = calculate_statistics(full_index, data[:, -1]*0., bs,
-                                        square=square, sparse=sparse
-                                        )
-        count = c
-        count_full = cf
+        (m, v, c, cf,forward_index) = calculate_statistics(full_index, np.zeros(data.shape[0]), bs,
+                                        square=square, sparse=sparse,
+                                        stable=stable, point_weights=weights)
     elif r == 1:
         (m, v, c, cf,forward_index) = calculate_statistics(full_index, data[:, -1], bs,
                                         square=square, sparse=sparse,
-                                        missing_data=missing_data)
-        count = c
-        count_full = cf
+                                        missing_data=missing_data, stable=stable,
+                                        point_weights=weights)
     else:
-        #if there's no missing data, generates a list of 'None's to fool the algorithm,
-        #otherwise there must be the correct number of missing data values for the
-        #size of the data. Also acceptable is to pass in a masked array instead,
-        #with no missing data.
-        if missing_data is None:
-            missing_data = [None for i in range(lb, data.shape[1])]
-        for i in range(lb, data.shape[1]):
-            (m, v, c, cf, forward_index) = calculate_statistics(full_index, data[:, i], bs,
-                                            square=square, sparse=sparse,
-                                            missing_data=missing_data[i - lb])
-            #If we wanted non-sparse data, m will be Naxis dimensional, so generate
-            #a slice-index thing for that shape
-            #otherwise generate a single dimension slice, with a blank axis at the
-            #end to allow concatenation
-            slall = slice(None, None, None)
-            if sparse is False:
-                sl = [slall for j in range(len(m.shape))]
-                sl.append(np.newaxis)
-            else:
-                sl = [slall, np.newaxis]
-                pass
-            #For the first element i==lb we need to create the final storage variables
-            #for other elements i>lb , we need to concatenate
-            if i == lb:
-                m2 = m[sl]
-                v2 = v[sl]
-                c2 = c[sl]
-                count = c
-                count_full = cf
-            else:
-                m2 = np.concatenate((m2, m[sl]), axis=-1)
-                v2 = np.concatenate((v2, v[sl]), axis=-1)
-                c2 = np.concatenate((c2, c[sl]), axis=-1)
-                pass
-            pass
-
-        m = m2
-        v = v2
-        c = c2
+        (m, v, c, cf, forward_index) = calculate_statistics(full_index, data[:, lb:], bs,
+                                        square=square, sparse=sparse,
+                                        missing_data=missing_data, stable=stable,
+                                        point_weights=weights)
+    count_full = cf
     #if we don't want to calculate the reverse indices array, we can stop here
     #otherwise we need to call the appropriate function and add the results
     #to the tuple we return
@@ -396,6 +633,1237 @@ def grid_data(data, bins, mn=None, mx=None,
     if sparse:
         result.append(forward_index)
     if reverse_indices:
-        ri, rj = calculate_reverse_indices(count_full, full_index, sparse=sparse)    
+        ri, rj = calculate_reverse_indices(count_full, full_index, sparse=sparse,
+                                           csr=reverse_indices == "csr")    
         result.extend([ri,rj])
     return result
+
+
+def calculate_moments(full_index, values, nbins, weights=None):
+    """
+    Calculates the count, mean and sum of squared deviations from the mean (M2)
+    of values in each of nbins bins indexed by full_index. The deviations are
+    taken from the bin mean (two passes), rather than by differencing the sum
+    of squares, so that the variance M2/count is accurate. With weights, the
+    count is the sum of the weights, and the mean and M2 are weighted.
+
+    :param full_index: bin of each element in values
+    :type full_index: numpy int array
+
+    :param values: data to bin
+    :type values: numpy array
+
+    :param nbins: number of bins
+    :type nbins: int
+
+    :param weights: weight of each element in values
+    :type weights: numpy array
+
+    :return: count, mean, M2 of each bin
+    :rtype: tuple of (numpy 1d, numpy 1d, numpy 1d)
+    """
+    values = np.asarray(values)
+    if weights is None:
+        count = np.bincount(full_index, minlength=nbins).astype(float)
+        su = np.bincount(full_index, weights=values, minlength=nbins)
+    else:
+        count = np.bincount(full_index, weights=weights, minlength=nbins)
+        su = np.bincount(full_index, weights=weights * values, minlength=nbins)
+    mean = np.zeros(nbins)
+    w = count != 0
+    mean[w] = su[w] / count[w]
+    deviation = (values - mean[full_index]) ** 2
+    if weights is not None:
+        deviation *= weights
+    m2 = np.bincount(full_index, weights=deviation, minlength=nbins)
+    return (count, mean, m2)
+
+
+def merge_moments(count, mean, m2, count_b, mean_b, m2_b):
+    """
+    Merges the count, mean and M2 of a second set of bins into the first, in place,
+    using the pairwise update of Chan et al. Bins that are empty in the second set
+    are left unchanged.
+    """
+    w = count_b != 0
+    n = count[w] + count_b[w]
+    delta = mean_b[w] - mean[w]
+    mean[w] += delta * (count_b[w] / n)
+    m2[w] += m2_b[w] + delta ** 2 * (count[w] * count_b[w] / n)
+    count[w] = n
+    return (count, mean, m2)
+
+
+class GridAccumulator(object):
+    """
+    Grids data that arrives in chunks (e.g. one orbit file at a time), holding
+    the count, mean and M2 of every bin and data column between updates.
+    Accumulators with the same bins can be merged, and finalize returns the
+    same (mean, variance, count) as grid_data would for all the data at once.
+
+    As the data range isn't known in advance, integer bins need both mn and mx.
+
+    Example::
+
+        acc = GridAccumulator([360, 180], mn=[-180, -90], mx=[180, 90])
+        for filename in files:
+            acc.update(read_orbit(filename))
+        mean, variance, count = acc.finalize()
+
+    :param bins: list of bin edges (upper edge) or bin lengths for each axis, as in grid_data
+    :type bins: list
+
+    :param mn: list of bin minima if the bins list contains integer number of bins
+    :type mn: list
+
+    :param mx: list of bin maxima if the bins list contains integer number of bins
+    :type mx: list
+
+    :param square: logical to determine if the mean of the square data is returned instead of variance
+    :type square: bool
+
+    :param missing_data: missing data value, or list of values for each data column
+    :type missing_data: float or list
+
+    :param periodic: list of logicals to determine if each axis wraps around from mx to mn
+    :type periodic: list
+    """
+    def __init__(self, bins, mn=None, mx=None, square=None, missing_data=None,
+                 periodic=None):
+        if type(bins[0]) == np.ndarray:
+            self.shape = [len(b) for b in bins]
+        else:
+            if mn is None or mx is None:
+                raise ValueError("GridAccumulator needs mn and mx for integer bins")
+            self.shape = [int(b) for b in bins]
+        self.bins = bins
+        self.mn = mn
+        self.mx = mx
+        self.periodic = periodic
+        self.square = square
+        self.missing_data = missing_data
+        self.size = grid_size(self.shape)
+        #the storage is allocated when the number of data columns is known
+        self.ncolumns = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def allocate(self, ncolumns):
+        """Creates the empty (bins, ncolumns) storage arrays"""
+        self.ncolumns = ncolumns
+        self.count = np.zeros((self.size, ncolumns))
+        self.mean = np.zeros((self.size, ncolumns))
+        self.m2 = np.zeros((self.size, ncolumns))
+
+    def missing_values(self):
+        """Returns the list of missing data values, one for each data column"""
+        return column_missing_data(self.missing_data, self.ncolumns)
+
+    def update(self, chunk):
+        """
+        Adds a chunk of data to the grid.
+
+        :param chunk: 2-dimensional(N,M) array of data, with the same columns as grid_data
+        :type chunk: numpy array
+
+        :return: the accumulator
+        :rtype: GridAccumulator
+        """
+        (full_index, bs) = calculate_full_index(chunk, self.bins,
+                                                mn=self.mn, mx=self.mx,
+                                                periodic=self.periodic)
+        lb = len(self.bins)
+        values = chunk[:, lb:]
+        #with no data columns, grid zeros, which gives the count
+        if values.shape[1] == 0:
+            values = np.zeros((chunk.shape[0], 1))
+        if self.ncolumns is None:
+            self.allocate(values.shape[1])
+        elif values.shape[1] != self.ncolumns:
+            raise ValueError("chunk has {0} data columns, expected {1}".format(
+                values.shape[1], self.ncolumns))
+        missing_data = self.missing_values()
+        for i in range(self.ncolumns):
+            (index, column) = valid_data(values[:, i], missing_data[i])
+            moments = calculate_moments(full_index[index], column, self.size)
+            merge_moments(self.count[:, i], self.mean[:, i], self.m2[:, i],
+                          *moments)
+        return self
+
+    def merge(self, other):
+        """
+        Merges the statistics of another accumulator with the same bins into this one.
+
+        :param other: accumulator to merge
+        :type other: GridAccumulator
+
+        :return: the accumulator
+        :rtype: GridAccumulator
+        """
+        if other.shape != self.shape:
+            raise ValueError("cannot merge grids of shape {0} and {1}".format(
+                other.shape, self.shape))
+        if other.ncolumns is None:
+            return self
+        if self.ncolumns is None:
+            self.allocate(other.ncolumns)
+        elif other.ncolumns != self.ncolumns:
+            raise ValueError("cannot merge {0} data columns with {1}".format(
+                other.ncolumns, self.ncolumns))
+        merge_moments(self.count, self.mean, self.m2,
+                      other.count, other.mean, other.m2)
+        return self
+
+    def finalize(self):
+        """
+        Returns the gridded statistics of all the data seen so far.
+
+        :return: Mean, Variance (or mean of square), Count, shaped as the output of grid_data
+        :rtype: tuple of (numpy (D+1)d, numpy (D+1)d, numpy (D+1)d)
+        """
+        if self.ncolumns is None:
+            self.allocate(1)
+        count = self.count
+        m = self.mean.copy()
+        v = np.zeros_like(m)
+        w = count != 0
+        v[w] = self.m2[w] / count[w]
+        #as grid_data, any square (even False) gives the mean of the square
+        if self.square is not None:
+            v = v + m * m
+        #If a column has no valid data at all, its mean is the missing value everywhere
+        for i, missing in enumerate(self.missing_values()):
+            if missing is not None and not np.any(count[:, i]):
+                m[:, i] = missing
+        shp = list(self.shape)
+        if self.ncolumns > 1:
+            shp = shp + [self.ncolumns]
+        return (np.reshape(m, shp), np.reshape(v, shp),
+                np.reshape(count.copy(), shp))
+
+
+class SparseGrid(object):
+    """
+    Gridded statistics of only the occupied bins of a grid, in coordinate (COO)
+    form: the sorted flat index (or, for grids too large to index, the index
+    along each axis) of each occupied bin, and the count, mean and M2
+    of each data column in those bins. The memory used is proportional to the
+    number of occupied bins, not the size of the grid, so very high resolution
+    grids can be used. Sparse grids of the same shape can be merged (e.g. from
+    separate files), and converted to dense arrays on demand.
+
+    :param shape: number of bins along each axis of the grid
+    :type shape: list
+
+    :param index: sorted flat index of each occupied bin, or None if coords are given
+    :type index: numpy int64 1d
+
+    :param count: count of the valid data in each occupied bin and data column
+    :type count: numpy 2d
+
+    :param mean: mean of the data in each occupied bin and data column
+    :type mean: numpy 2d
+
+    :param m2: sum of squared deviations from the mean in each occupied bin and data column
+    :type m2: numpy 2d
+
+    :param square: logical to determine if the mean of the square data is returned instead of variance
+    :type square: bool
+
+    :param missing_data: list of missing data values for each data column
+    :type missing_data: list
+
+    :param coords: index along each axis of each occupied bin (nbins, A), in lexicographic order, for grids without a flat index
+    :type coords: numpy int64 2d
+    """
+    def __init__(self, shape, index, count, mean, m2, square=None,
+                 missing_data=None, coords=None):
+        self.shape = [int(b) for b in shape]
+        if index is not None:
+            index = np.asarray(index, dtype=np.int64)
+        self.index = index
+        self._coords = coords
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.square = square
+        self.missing_data = column_missing_data(missing_data, count.shape[1])
+
+    def __len__(self):
+        return self.count.shape[0]
+
+    @property
+    def ncolumns(self):
+        return self.count.shape[1]
+
+    @property
+    def coords(self):
+        """Tuple of the (int64) grid index along each axis of every occupied bin"""
+        if self.index is None:
+            return tuple(self._coords.T)
+        return np.unravel_index(self.index, self.shape)
+
+    def statistics(self):
+        """
+        Returns the mean, variance (or mean of square) and count of each data column
+        in the occupied bins.
+
+        :return: Mean, Variance (or mean of square), Count
+        :rtype: tuple of (numpy 2d, numpy 2d, numpy 2d)
+        """
+        m = self.mean.copy()
+        v = np.zeros_like(m)
+        w = self.count != 0
+        v[w] = self.m2[w] / self.count[w]
+        if self.square is not None:
+            v = v + m * m
+        #If a column has no valid data at all, its mean is the missing value everywhere
+        for i, missing in enumerate(self.missing_data):
+            if missing is not None and not np.any(self.count[:, i]):
+                m[:, i] = missing
+        return (m, v, self.count.copy())
+
+    def merge(self, other):
+        """
+        Returns a new sparse grid with the statistics of this grid and other, in
+        the union of their occupied bins.
+
+        :param other: grid to merge
+        :type other: SparseGrid
+
+        :return: the merged grid
+        :rtype: SparseGrid
+        """
+        if other.shape != self.shape:
+            raise ValueError("cannot merge grids of shape {0} and {1}".format(
+                other.shape, self.shape))
+        if other.ncolumns != self.ncolumns:
+            raise ValueError("cannot merge {0} data columns with {1}".format(
+                other.ncolumns, self.ncolumns))
+        coords = None
+        if self.index is not None and other.index is not None:
+            index = np.union1d(self.index, other.index)
+            place = np.searchsorted(index, self.index)
+            other_place = np.searchsorted(index, other.index)
+            nbins = index.size
+        else:
+            #without flat indices, find the union of the axis indices
+            index = None
+            (coords, place) = unique_rows(np.concatenate(
+                [np.column_stack(self.coords), np.column_stack(other.coords)]))
+            (place, other_place) = (place[:len(self)], place[len(self):])
+            nbins = coords.shape[0]
+        shp = (nbins, self.ncolumns)
+        (count, mean, m2) = (np.zeros(shp), np.zeros(shp), np.zeros(shp))
+        count[place] = self.count
+        mean[place] = self.mean
+        m2[place] = self.m2
+        moments = merge_moments(count[other_place], mean[other_place],
+                                m2[other_place],
+                                other.count, other.mean, other.m2)
+        (count[other_place], mean[other_place], m2[other_place]) = moments
+        return SparseGrid(self.shape, index, count, mean, m2,
+                          square=self.square, missing_data=self.missing_data,
+                          coords=coords)
+
+    def todense(self):
+        """
+        Returns the mean, variance (or mean of square) and count on the full grid,
+        as the dense output of grid_data.
+
+        :return: Mean, Variance (or mean of square), Count
+        :rtype: tuple of (numpy (D+1)d, numpy (D+1)d, numpy (D+1)d)
+        """
+        sz = grid_size(self.shape)
+        if self.index is None:
+            raise OverflowError("a grid of {0} bins is too large to be dense".format(sz))
+        shp = list(self.shape)
+        if self.ncolumns > 1:
+            shp = shp + [self.ncolumns]
+        result = []
+        for (i, sparse) in enumerate(self.statistics()):
+            dense = np.zeros((sz, self.ncolumns))
+            if i == 0:
+                #the mean of a column without any data is the missing value
+                for j, missing in enumerate(self.missing_data):
+                    if missing is not None and not np.any(self.count[:, j]):
+                        dense[:, j] = missing
+            dense[self.index] = sparse
+            result.append(np.reshape(dense, shp))
+        return tuple(result)
+
+
+def grid_data_sparse(data, bins, mn=None, mx=None, square=None,
+                     missing_data=None, periodic=None):
+    """Grids data as grid_data, but only holds the occupied bins, returning a
+    SparseGrid. The memory used scales with the data and the number of occupied
+    bins, never with the size of the grid. Grids with more bins than a 64 bit
+    integer can index are binned by sorting the index along each axis.
+
+    :param data: 2-dimensional(N,M) array of data to grid, with the same columns as grid_data
+    :type data: numpy array
+
+    :param bins: list of bin edges (upper edge) or bin lengths for each axis in A
+    :type bins: list
+
+    :param mn: list of bin minima if the bins list contains integer number of bins
+    :type mn: list
+
+    :param mx: list of bin maxima if the bins list contains integer number of bins
+    :type mx: list
+
+    :param square: logical to determine if the mean of the square data is returned instead of variance
+    :type square: bool
+
+    :param missing_data: list of missing data entries for each data array in D
+    :type missing_data: list
+
+    :param periodic: list of logicals to determine if each axis wraps around from mx to mn
+    :type periodic: list
+
+    :return: the occupied bins
+    :rtype: SparseGrid
+    """
+    #grids too large for a flat index are indexed by their occupied bins
+    bs = [len(b) for b in bins] if type(bins[0]) == np.ndarray else bins
+    if grid_size(bs) - 1 > np.iinfo(np.int64).max:
+        (inverse, coords, bs) = calculate_sparse_index(data, bins, mn=mn, mx=mx,
+                                                       periodic=periodic)
+        index = None
+    else:
+        (full_index, bs) = calculate_full_index(data, bins, mn=mn, mx=mx,
+                                                periodic=periodic)
+        (index, inverse) = np.unique(full_index, return_inverse=True)
+        inverse = np.ravel(inverse)
+        coords = None
+    values = data[:, len(bins):]
+    if values.shape[1] == 0:
+        values = np.zeros((data.shape[0], 1))
+    ncolumns = values.shape[1]
+    missing_data = column_missing_data(missing_data, ncolumns)
+    nbins = inverse.max() + 1 if inverse.size else 0
+    shp = (nbins, ncolumns)
+    (count, mean, m2) = (np.zeros(shp), np.zeros(shp), np.zeros(shp))
+    for i in range(ncolumns):
+        (valid, column) = valid_data(values[:, i], missing_data[i])
+        (count[:, i], mean[:, i], m2[:, i]) = \
+            calculate_moments(inverse[valid], column, nbins)
+    return SparseGrid(bs, index, count, mean, m2, square=square,
+                      missing_data=missing_data, coords=coords)
+
+
+def shared_array(shape, dtype=float, name=None):
+    """
+    Returns a numpy array in shared memory, and the SharedMemory block that holds it.
+    A new block is created unless the name of an existing block is given.
+    """
+    #shared memory needs python 3.8, so only import it when it's used
+    from multiprocessing import shared_memory
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if name is None:
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+    return (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+#the state of each grid_data_parallel worker process, set by _grid_worker_init
+_grid_worker = {}
+
+
+def _grid_worker_init(spec, slots):
+    """
+    Attaches a grid_data_parallel worker to the shared input and output arrays,
+    and creates an accumulator that updates the worker's own output slot in place.
+    """
+    blocks = []
+    shm, output = shared_array(spec["output_shape"], name=spec["output"])
+    blocks.append(shm)
+    slot = output[slots.get()]
+    acc = GridAccumulator(spec["bins"], mn=spec["mn"], mx=spec["mx"],
+                          missing_data=spec["missing_data"],
+                          periodic=spec["periodic"])
+    acc.ncolumns = spec["output_shape"][-1]
+    (acc.count, acc.mean, acc.m2) = slot
+    data = None
+    if spec["input"] is not None:
+        shm, data = shared_array(spec["input_shape"], spec["input_dtype"],
+                                 name=spec["input"])
+        blocks.append(shm)
+        if spec["mask"] is not None:
+            shm, mask = shared_array(spec["input_shape"], bool, name=spec["mask"])
+            blocks.append(shm)
+            data = np.ma.array(data, mask=mask, copy=False)
+    _grid_worker.update(acc=acc, data=data, reader=spec["reader"], blocks=blocks)
+
+
+def _grid_worker_task(task):
+    """Grids one shard (a range of rows, or an input for the reader) into the worker's slot"""
+    if _grid_worker["reader"] is None:
+        chunk = _grid_worker["data"][task[0]:task[1]]
+    else:
+        chunk = _grid_worker["reader"](task)
+    _grid_worker["acc"].update(chunk)
+    return chunk.shape[0]
+
+
+def grid_data_parallel(data, bins, mn=None, mx=None, square=None,
+                       missing_data=None, processes=None, chunksize=None,
+                       reader=None, ncolumns=None, periodic=None):
+    """Grids data as grid_data, but split across a pool of processes.
+    Each process grids its shards of the data into its own count, mean and M2
+    arrays held in shared memory, so the partial grids aren't pickled back, and
+    the partial grids are merged at the end. The input array is also placed in
+    shared memory, and each process reads ranges of rows.
+    Alternatively, data can be a list of inputs (e.g. filenames) and reader a
+    function that returns the N*M array of an input, called in the worker
+    processes. The reader must be picklable (e.g. a module level function) and
+    integer bins need mn and mx.
+    Only the dense (mean, variance, count) output is available, not the
+    sparse or reverse_indices options.
+
+    :param data: 2-dimensional(N,M) array of data to grid, or list of inputs to reader
+    :type data: numpy array or list
+
+    :param bins: list of bin edges (upper edge) or bin lengths for each axis in A
+    :type bins: list
+
+    :param mn: list of bin minima if the bins list contains integer number of bins
+    :type mn: list
+
+    :param mx: list of bin maxima if the bins list contains integer number of bins
+    :type mx: list
+
+    :param square: logical to determine if the mean of the square data mean(X**2) is returned instead of variance
+    :type square: bool
+
+    :param missing_data: list of missing data entries for each data array in D
+    :type missing_data: list
+
+    :param processes: number of worker processes, the number of CPUs by default
+    :type processes: int
+
+    :param chunksize: number of rows in each shard of an input array
+    :type chunksize: int
+
+    :param reader: function returning the data array of each element in data
+    :type reader: function
+
+    :param ncolumns: number of data columns D returned by reader, by default found from the first input
+    :type ncolumns: int
+
+    :param periodic: list of logicals to determine if each axis wraps around from mx to mn, integer bins only
+    :type periodic: list
+
+    :return: Mean, Variance (or mean of square) and Count of each grid box
+    :rtype: tuple of (numpy (D+1)d, numpy (D+1)d, numpy (D+1)d)
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if reader is None:
+        data = np.asanyarray(data)
+        if type(bins[0]) != np.ndarray:
+            #if min or max are not given, calculate them
+            if mn is None:
+                mn = np.min(data, 0)
+            if mx is None:
+                mx = np.max(data, 0)
+        if ncolumns is None:
+            ncolumns = data.shape[1] - len(bins)
+        if chunksize is None:
+            chunksize = -(-data.shape[0] // (4 * processes))
+        chunksize = max(int(chunksize), 1)
+        tasks = [(start, min(start + chunksize, data.shape[0]))
+                 for start in range(0, data.shape[0], chunksize)]
+    else:
+        tasks = list(data)
+        if ncolumns is None:
+            ncolumns = reader(tasks[0]).shape[1] - len(bins)
+    #with no data columns, zeros are gridded, which gives the count
+    ncolumns = max(ncolumns, 1)
+
+    acc = GridAccumulator(bins, mn=mn, mx=mx, square=square,
+                          missing_data=missing_data, periodic=periodic)
+    acc.allocate(ncolumns)
+    if processes == 1:
+        for task in tasks:
+            acc.update(data[task[0]:task[1]] if reader is None else reader(task))
+        return acc.finalize()
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    blocks = []
+    try:
+        #one (count, mean, M2) slot for each worker
+        output_shape = (processes, 3, acc.size, ncolumns)
+        shm, output = shared_array(output_shape)
+        blocks.append(shm)
+        output[...] = 0
+        spec = dict(bins=bins, mn=mn, mx=mx, missing_data=missing_data,
+                    periodic=periodic, reader=reader, output=shm.name, output_shape=output_shape,
+                    input=None, input_shape=None, input_dtype=None, mask=None)
+        if reader is None:
+            shm, shared = shared_array(data.shape, data.dtype)
+            blocks.append(shm)
+            shared[...] = np.ma.getdata(data)
+            spec.update(input=shm.name, input_shape=data.shape,
+                        input_dtype=data.dtype.str)
+            if isinstance(data, np.ma.MaskedArray):
+                shm, mask = shared_array(data.shape, bool)
+                blocks.append(shm)
+                mask[...] = np.ma.getmaskarray(data)
+                spec.update(mask=shm.name)
+        context = multiprocessing.get_context()
+        slots = context.Queue()
+        for slot in range(processes):
+            slots.put(slot)
+        with ProcessPoolExecutor(processes, mp_context=context,
+                                 initializer=_grid_worker_init,
+                                 initargs=(spec, slots)) as pool:
+            for rows in pool.map(_grid_worker_task, tasks):
+                pass
+        #merge the partial grids of every worker
+        for slot in output:
+            merge_moments(acc.count, acc.mean, acc.m2, *slot)
+        return acc.finalize()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def segment_reduce(ufunc, values, offsets):
+    """
+    Reduces the values in each segment values[offsets[i]:offsets[i+1]] with ufunc
+    (e.g. np.minimum), using a single ufunc.reduceat over the non-empty segments.
+    Empty segments are NaN.
+    """
+    counts = np.diff(offsets)
+    occupied = counts != 0
+    result = np.full(counts.size, np.nan)
+    if np.any(occupied):
+        result[occupied] = ufunc.reduceat(values, offsets[:-1][occupied])
+    return result
+
+
+def segment_percentile(values, offsets, q):
+    """
+    Returns the q'th percentile of each segment values[offsets[i]:offsets[i+1]],
+    where the values of each segment are sorted, interpolated linearly between
+    the closest values as numpy.percentile. Empty segments are NaN.
+    """
+    counts = np.diff(offsets)
+    occupied = counts != 0
+    result = np.full(counts.size, np.nan)
+    position = (counts[occupied] - 1) * (q / 100.)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, counts[occupied] - 1)
+    start = offsets[:-1][occupied]
+    low = values[start + lower]
+    result[occupied] = low + (values[start + upper] - low) * (position - lower)
+    return result
+
+
+def _reduce_count(values, offsets, weights):
+    return np.diff(offsets).astype(float)
+
+
+def _reduce_sum(values, offsets, weights):
+    return segment_reduce(np.add, values, offsets)
+
+
+def _reduce_mean(values, offsets, weights):
+    return segment_reduce(np.add, values, offsets) / np.diff(offsets)
+
+
+def _reduce_min(values, offsets, weights):
+    return segment_reduce(np.minimum, values, offsets)
+
+
+def _reduce_max(values, offsets, weights):
+    return segment_reduce(np.maximum, values, offsets)
+
+
+def _reduce_weighted_mean(values, offsets, weights):
+    if weights is None:
+        raise ValueError("the weighted_mean reducer needs weights")
+    return segment_reduce(np.add, values * weights, offsets) / \
+        segment_reduce(np.add, weights, offsets)
+
+
+def _reduce_median(values, offsets, weights):
+    return segment_percentile(values, offsets, 50.)
+
+
+#the reducers available to grid_reduce, as name : (function, ordered)
+#see register_reducer
+_reducers = {}
+
+
+def register_reducer(name, function, ordered=False):
+    """
+    Adds a reducer to those available to grid_reduce, replacing any of the same name.
+    The function is called as function(values, offsets, weights) for each data column,
+    where values[offsets[i]:offsets[i+1]] are the data in bin i (and weights the
+    corresponding weights, or None), and returns an array of the result of each bin.
+    Bins without data are filled after the call, so their result is ignored.
+
+    :param name: name of the reducer
+    :type name: str
+
+    :param function: the reducer
+    :type function: function
+
+    :param ordered: logical to determine if the values in each bin need to be sorted
+    :type ordered: bool
+    """
+    _reducers[name] = (function, ordered)
+
+
+register_reducer("count", _reduce_count)
+register_reducer("sum", _reduce_sum)
+register_reducer("mean", _reduce_mean)
+register_reducer("min", _reduce_min)
+register_reducer("max", _reduce_max)
+register_reducer("weighted_mean", _reduce_weighted_mean)
+register_reducer("median", _reduce_median, ordered=True)
+
+
+def get_reducer(name):
+    """
+    Returns the (function, ordered) pair of a named reducer. As well as the
+    registered reducers, percentileQ (e.g. percentile90) is the Q'th percentile.
+    """
+    if name in _reducers:
+        return _reducers[name]
+    match = re.match(r"^percentile(\d+(\.\d*)?)$", name)
+    if match:
+        q = float(match.group(1))
+        if q > 100:
+            raise ValueError("percentile {0} is above 100".format(q))
+        return (lambda values, offsets, weights:
+                segment_percentile(values, offsets, q), True)
+    raise ValueError("unknown reducer {0}, available reducers are {1} "
+                     "and percentileQ".format(name, sorted(_reducers)))
+
+
+def grid_reduce(data, bins, reducers=("mean",), mn=None, mx=None,
+                weights=None, sparse=False, missing_data=None, fill=np.nan,
+                periodic=None):
+    """Grids data as grid_data, but calculates any of a set of reductions of
+    the data in each bin: count, sum, mean, min, max, weighted_mean (with
+    weights), median, percentileQ (e.g. percentile90 for the 90th percentile),
+    or any reducer added by register_reducer.
+    The data of each column are sorted by bin once (and by value within each bin,
+    if a reducer needs it), and every reduction is then a segment reduction
+    over the sorted data (e.g. np.minimum.reduceat), without a loop over bins.
+
+    :param data: 2-dimensional(N,M) array of data to grid, with the same columns as grid_data
+    :type data: numpy array
+
+    :param bins: list of bin edges (upper edge) or bin lengths for each axis in A
+    :type bins: list
+
+    :param reducers: names of the reductions to calculate
+    :type reducers: list
+
+    :param mn: list of bin minima if the bins list contains integer number of bins
+    :type mn: list
+
+    :param mx: list of bin maxima if the bins list contains integer number of bins
+    :type mx: list
+
+    :param weights: weight of each of the N elements of data, for weighted_mean
+    :type weights: numpy 1d
+
+    :param sparse: logical to determine if the sparse method is used instead and a 1D gridded dataset is created
+    :type sparse: bool
+
+    :param missing_data: list of missing data entries for each data array in D
+    :type missing_data: list
+
+    :param fill: value of the bins without any data
+    :type fill: float
+
+    :param periodic: list of logicals to determine if each axis wraps around from mx to mn, integer bins only
+    :type periodic: list
+
+    :return: dictionary of the gridded result of each reducer, plus forward_index if sparse
+    :rtype: dict
+    """
+    (full_index, bs) = calculate_full_index(data, bins, mn=mn, mx=mx,
+                                            periodic=periodic)
+    reducers = [(name,) + get_reducer(name) for name in reducers]
+    ordered = any(reducer[2] for reducer in reducers)
+    values = data[:, len(bins):]
+    single = values.shape[1] <= 1
+    if values.shape[1] == 0:
+        values = np.zeros((data.shape[0], 1))
+    ncolumns = values.shape[1]
+    missing_data = column_missing_data(missing_data, ncolumns)
+    if weights is not None:
+        weights = np.asarray(weights)
+
+    #the bins are the flat index (dense) or the unique values of full_index (sparse)
+    result = dict()
+    if sparse is False:
+        inverse = np.ravel(full_index)
+        nbins = grid_size(bs)
+        shp = list(bs)
+    else:
+        (forward_index, inverse) = np.unique(full_index, return_inverse=True)
+        inverse = np.ravel(inverse)
+        nbins = forward_index.size
+        shp = [nbins]
+        result["forward_index"] = forward_index.astype(np.int64)
+    if not single:
+        shp = shp + [ncolumns]
+
+    output = dict((reducer[0], np.zeros((nbins, ncolumns)))
+                  for reducer in reducers)
+    for i in range(ncolumns):
+        (index, column_values) = valid_data(values[:, i], missing_data[i])
+        column_bins = inverse[index]
+        #the single sort that groups the data by bin (and by value within a bin)
+        if ordered:
+            order = np.lexsort((column_values, column_bins))
+        else:
+            order = np.argsort(column_bins, kind="stable")
+        sorted_values = column_values[order]
+        sorted_weights = None if weights is None else weights[index][order]
+        counts = np.bincount(column_bins, minlength=nbins)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        for (name, function, _) in reducers:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                reduced = function(sorted_values, offsets, sorted_weights)
+            if name != "count":
+                reduced = np.where(counts != 0, reduced, fill)
+            output[name][:, i] = reduced
+    for name in output:
+        result[name] = np.reshape(output[name], shp)
+    return result
+
+
+def kernel_stencil(radius, kernel="box", sigma=None):
+    """
+    Returns the offsets (in bins) and weights of a kernel that spreads one element
+    over every bin within radius bins of its own bin along each axis. The weights
+    are normalised to sum to one.
+
+    :param radius: half width of the stencil in bins along each axis
+    :type radius: list
+
+    :param kernel: "box" (equal weights), "gaussian", or a function of the offsets (S,A) returning their weights
+    :type kernel: str or function
+
+    :param sigma: standard deviation of the gaussian kernel in bins along each axis, by default radius/2
+    :type sigma: list
+
+    :return: offsets, the bin offset of each point of the stencil along each axis (S,A)
+    :return: weights, the weight of each point of the stencil
+    :rtype: tuple of (numpy int64 2d, numpy 1d)
+    """
+    radius = [int(r) for r in radius]
+    offsets = np.meshgrid(*[np.arange(-r, r + 1) for r in radius], indexing="ij")
+    offsets = np.column_stack([np.ravel(o) for o in offsets])
+    if callable(kernel):
+        weights = np.asarray(kernel(offsets), dtype=float)
+    elif kernel == "box":
+        weights = np.ones(offsets.shape[0])
+    elif kernel == "gaussian":
+        if sigma is None:
+            sigma = [max(r, 1) / 2. for r in radius]
+        distance = offsets / np.asarray(sigma, dtype=float)
+        weights = np.exp(-0.5 * np.sum(distance ** 2, axis=1))
+    else:
+        raise ValueError("unknown kernel {0}, use box, gaussian or a "
+                         "function".format(kernel))
+    keep = weights > 0
+    return (offsets[keep], weights[keep] / np.sum(weights[keep]))
+
+
+def calculate_footprint_index(data, bins, stencil, mn=None, mx=None,
+                              periodic=None):
+    """
+    Calculates the index into the flattened grid of every bin that each element of
+    data is spread over by a stencil (from kernel_stencil). The stencil is clipped
+    at the edges of the grid, except along periodic axes, where it wraps around.
+    Only the index, element and weight of each (element, stencil point) pair inside
+    the grid are held, N*S values each, and never copies of the data.
+    The other arguments are as calculate_full_index.
+
+    :return: full_index, the flat index of each bin an element is spread over
+    :return: element, the element of data spread into each bin in full_index
+    :return: weights, the stencil weight of each bin in full_index
+    :return: bs, the number of bins along each axis
+    :rtype: tuple of (numpy 1d, numpy int64 1d, numpy 1d, list)
+    """
+    (offsets, weights) = stencil
+    (bs, axis_indices) = calculate_axis_indices(data, bins, mn=mn, mx=mx,
+                                                periodic=periodic)
+    if periodic is None:
+        periodic = [False] * len(bs)
+    #build the flat index of every stencil point of every element at once, as in
+    #calculate_full_index, noting the points that fall off the edge of the grid
+    full_index = np.zeros((data.shape[0], offsets.shape[0]),
+                          dtype=index_dtype(grid_size(bs)))
+    inside = np.ones(full_index.shape, dtype=bool)
+    for (i, (d, index)) in enumerate(zip(bs, axis_indices)):
+        neighbour = index[:, np.newaxis] + offsets[:, i]
+        if periodic[i]:
+            neighbour %= d
+        else:
+            inside &= (neighbour >= 0) & (neighbour < d)
+        fold_index(full_index, d, neighbour)
+    (element, point) = np.nonzero(inside)
+    return (full_index[inside], element, weights[point], bs)
+
+
+def grid_footprint(data, bins, radius, kernel="box", sigma=None, mn=None,
+                   mx=None, square=None, missing_data=None, weights=None,
+                   periodic=None):
+    """Grids data as grid_data, but spreads each element over the neighbouring bins
+    with a kernel, for elements (e.g. instrument footprints) larger than a bin.
+    Each element contributes to every bin within radius bins of its own bin, with
+    the weight of the kernel at that offset. The stencil of offsets is calculated
+    once, and the elements are added to all of their bins in one scatter-add for
+    each data column, so the memory used is proportional to N*S (the size of the
+    stencil), and the data are never duplicated.
+    The stencil is clipped at the edge of the grid, so elements near the edge
+    contribute less weight, but the means are not biased.
+
+    :param data: 2-dimensional(N,M) array of data to grid, with the same columns as grid_data
+    :type data: numpy array
+
+    :param bins: list of bin edges (upper edge) or bin lengths for each axis in A
+    :type bins: list
+
+    :param radius: half width of the kernel in bins along each axis
+    :type radius: list
+
+    :param kernel: "box", "gaussian", or a function of the offsets, as in kernel_stencil
+    :type kernel: str or function
+
+    :param sigma: standard deviation of the gaussian kernel in bins along each axis
+    :type sigma: list
+
+    :param mn: list of bin minima if the bins list contains integer number of bins
+    :type mn: list
+
+    :param mx: list of bin maxima if the bins list contains integer number of bins
+    :type mx: list
+
+    :param square: logical to determine if the mean of the square data mean(X**2) is returned instead of variance
+    :type square: bool
+
+    :param missing_data: list of missing data entries for each data array in D
+    :type missing_data: list
+
+    :param weights: weight of each of the N elements, or a function of data returning them, multiplied by the kernel weights
+    :type weights: numpy 1d or function
+
+    :param periodic: list of logicals to determine if each axis wraps around from mx to mn, integer bins only
+    :type periodic: list
+
+    :return: Mean, kernel weighted mean value of each grid box
+    :return: Variance, kernel weighted variance of each grid box (or mean of square)
+    :return: Count, total kernel weight of the elements in each grid box
+    :rtype: tuple of (numpy (D+1)d, numpy (D+1)d, numpy (D+1)d)
+    """
+    stencil = kernel_stencil(radius, kernel=kernel, sigma=sigma)
+    (full_index, element, kernel_weights, bs) = calculate_footprint_index(
+        data, bins, stencil, mn=mn, mx=mx, periodic=periodic)
+    if callable(weights):
+        weights = weights(data)
+    if weights is not None:
+        kernel_weights *= np.nan_to_num(np.asarray(weights, dtype=float))[element]
+    values = data[:, len(bins):]
+    single = values.shape[1] <= 1
+    if values.shape[1] == 0:
+        values = np.zeros((data.shape[0], 1))
+    ncolumns = values.shape[1]
+    missing_data = column_missing_data(missing_data, ncolumns)
+    nbins = grid_size(bs)
+    shp = (nbins, ncolumns)
+    (count, mean, var) = (np.zeros(shp), np.zeros(shp), np.zeros(shp))
+    for i in range(ncolumns):
+        #the valid elements, and so the stencil points, of this column
+        valid = valid_index(values[:, i], missing_data[i])
+        if not isinstance(valid, slice):
+            valid = valid[element]
+        column = np.ma.getdata(values[:, i])[element[valid]]
+        (count[:, i], mean[:, i], var[:, i]) = calculate_moments(
+            full_index[valid], column, nbins, weights=kernel_weights[valid])
+        w = count[:, i] != 0
+        var[w, i] = var[w, i] / count[w, i]
+        if square is not None:
+            var[:, i] += mean[:, i] ** 2
+        if missing_data[i] is not None and not np.any(w):
+            mean[:, i] = missing_data[i]
+    cshp = list(bs) if single else list(bs) + [ncolumns]
+    return (np.reshape(mean, cshp), np.reshape(var, cshp),
+            np.reshape(count, cshp))
+
+
+def cell_areas(lat_edges, lon_edges, radius=1.0):
+    """
+    Returns the area of each cell of a latitude/longitude grid, from the cell edges
+    in degrees, radius**2 * dlon * (sin(lat2) - sin(lat1)).
+
+    :param lat_edges: the nlat+1 latitude edges of the cells
+    :type lat_edges: numpy 1d
+
+    :param lon_edges: the nlon+1 longitude edges of the cells
+    :type lon_edges: numpy 1d
+
+    :param radius: radius of the sphere
+    :type radius: float
+
+    :return: area of each cell
+    :rtype: numpy 2d (nlat, nlon)
+    """
+    band = np.abs(np.diff(np.sin(np.radians(lat_edges))))
+    width = np.abs(np.diff(np.radians(lon_edges)))
+    return radius ** 2 * np.outer(band, width)
+
+
+def area_weighted_mean(field, lat_edges, lon_edges=None, lat_axis=0, lon_axis=1,
+                       count=None, zonal=False):
+    """
+    Returns the area weighted global (or zonal) mean of a gridded latitude/longitude
+    field, such as the mean returned by grid_data. Cells without any data (where
+    count is zero) are left out of the mean. Any other axes (e.g. the data columns,
+    altitude) are kept.
+
+    :param field: gridded field
+    :type field: numpy array
+
+    :param lat_edges: the nlat+1 latitude edges of the cells
+    :type lat_edges: numpy 1d
+
+    :param lon_edges: the nlon+1 longitude edges of the cells, uniform if not given
+    :type lon_edges: numpy 1d
+
+    :param lat_axis: latitude axis of field
+    :type lat_axis: int
+
+    :param lon_axis: longitude axis of field
+    :type lon_axis: int
+
+    :param count: count of each cell of field (e.g. from grid_data), zero if the cell is empty
+    :type count: numpy array
+
+    :param zonal: logical to determine if the zonal mean (of each latitude) is returned instead of the global mean
+    :type zonal: bool
+
+    :return: the global mean (without the latitude and longitude axes) or zonal mean (without the longitude axis)
+    :rtype: numpy array
+    """
+    field = np.asarray(field)
+    lat_axis = lat_axis % field.ndim
+    lon_axis = lon_axis % field.ndim
+    if lon_edges is None:
+        lon_edges = np.linspace(0., 360., field.shape[lon_axis] + 1)
+    area = cell_areas(lat_edges, lon_edges)
+    if lat_axis > lon_axis:
+        area = area.T
+    #broadcast the areas along the latitude and longitude axes of field
+    shape = [1] * field.ndim
+    shape[lat_axis] = field.shape[lat_axis]
+    shape[lon_axis] = field.shape[lon_axis]
+    area = np.reshape(area, shape)
+    if count is not None:
+        area = np.where(np.asarray(count) != 0, area, 0.)
+        field = np.where(np.asarray(count) != 0, field, 0.)
+    axes = (lon_axis,) if zonal else (lat_axis, lon_axis)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(area * field, axis=axes) / \
+            np.sum(np.broadcast_to(area, field.shape), axis=axes)
+
+
+class ClimatologyAxis(object):
+    """
+    An axis of a Climatology, with nbins uniform bins between mn and mx. Periodic
+    axes (e.g. longitude, local time, solar longitude) wrap around from mx to mn.
+
+    :param name: name of the axis (and of its NetCDF dimension and coordinate)
+    :type name: str
+
+    :param nbins: number of bins
+    :type nbins: int
+
+    :param mn: lower edge of the first bin
+    :type mn: float
+
+    :param mx: upper edge of the last bin
+    :type mx: float
+
+    :param periodic: logical to determine if the axis wraps around, with period mx-mn
+    :type periodic: bool
+
+    :param units: units of the axis
+    :type units: str
+    """
+    def __init__(self, name, nbins, mn, mx, periodic=False, units=None):
+        self.name = name
+        self.nbins = int(nbins)
+        self.mn = mn
+        self.mx = mx
+        self.periodic = periodic
+        self.units = units
+
+    @property
+    def edges(self):
+        """The nbins+1 bin edges"""
+        return np.linspace(self.mn, self.mx, self.nbins + 1)
+
+    @property
+    def centres(self):
+        """The centre of each bin"""
+        edges = self.edges
+        return (edges[1:] + edges[:-1]) / 2.
+
+
+class Climatology(object):
+    """
+    Builds a climatology of some variables, binned along axes such as latitude,
+    longitude, local time and season, from data added incrementally (e.g. one file
+    at a time) and writes it to NetCDF. The data, as in grid_data, have a column for
+    each axis followed by a column for each variable.
+
+    Example::
+
+        clim = Climatology([ClimatologyAxis("lat", 36, -90, 90, units="degrees_north"),
+                            ClimatologyAxis("lon", 72, 0, 360, periodic=True, units="degrees_east"),
+                            ClimatologyAxis("local_time", 24, 0, 24, periodic=True, units="hours")],
+                           ["temperature"])
+        clim.add_files(filenames, read_orbit)
+        clim.to_netcdf("climatology.nc")
+
+    :param axes: the axes of the climatology
+    :type axes: list of ClimatologyAxis
+
+    :param variables: names of the variables
+    :type variables: list
+
+    :param missing_data: missing data value, or list of values for each variable
+    :type missing_data: float or list
+    """
+    def __init__(self, axes, variables, missing_data=None):
+        self.axes = list(axes)
+        self.variables = list(variables)
+        self.files = []
+        self.accumulator = GridAccumulator(
+            [a.nbins for a in self.axes],
+            mn=[a.mn for a in self.axes], mx=[a.mx for a in self.axes],
+            missing_data=missing_data,
+            periodic=[a.periodic for a in self.axes])
+        self.accumulator.allocate(len(self.variables))
+
+    @property
+    def shape(self):
+        return [a.nbins for a in self.axes]
+
+    def update(self, data):
+        """
+        Adds data to the climatology.
+
+        :param data: 2-dimensional(N, axes+variables) array of data
+        :type data: numpy array
+
+        :return: the climatology
+        :rtype: Climatology
+        """
+        if data.shape[1] != len(self.axes) + len(self.variables):
+            raise ValueError("data has {0} columns, expected {1} axes and {2} variables".format(
+                data.shape[1], len(self.axes), len(self.variables)))
+        self.accumulator.update(data)
+        return self
+
+    def add_files(self, filenames, reader):
+        """
+        Adds the data of each file to the climatology.
+
+        :param filenames: the files to add
+        :type filenames: list
+
+        :param reader: function returning the data array of a file
+        :type reader: function
+
+        :return: the climatology
+        :rtype: Climatology
+        """
+        for filename in filenames:
+            self.update(reader(filename))
+            self.files.append(filename)
+        return self
+
+    def merge(self, other):
+        """
+        Merges another climatology with the same axes and variables into this one.
+
+        :param other: climatology to merge
+        :type other: Climatology
+
+        :return: the climatology
+        :rtype: Climatology
+        """
+        self.accumulator.merge(other.accumulator)
+        self.files.extend(other.files)
+        return self
+
+    def finalize(self):
+        """
+        Returns the mean, variance and count of each variable, with the variables
+        as the last dimension.
+
+        :return: Mean, Variance, Count
+        :rtype: tuple of (numpy (A+1)d, numpy (A+1)d, numpy (A+1)d)
+        """
+        shp = self.shape + [len(self.variables)]
+        return tuple(np.reshape(x, shp) for x in self.accumulator.finalize())
+
+    def to_netcdf(self, filename, attributes=None):
+        """
+        Writes the climatology to a NetCDF file, with a coordinate variable (the bin
+        centres) and bounds for each axis, and the mean (named as the variable),
+        variance (_variance) and count (_count) of each variable. Bins without data
+        are filled.
+
+        :param filename: name of the NetCDF file
+        :type filename: str
+
+        :param attributes: global attributes of the file
+        :type attributes: dict
+        """
+        import netCDF4
+        (mean, variance, count) = self.finalize()
+        dimensions = tuple(a.name for a in self.axes)
+        with netCDF4.Dataset(filename, "w") as nc:
+            nc.createDimension("nv", 2)
+            for axis in self.axes:
+                nc.createDimension(axis.name, axis.nbins)
+                coordinate = nc.createVariable(axis.name, "f8", (axis.name,))
+                coordinate[:] = axis.centres
+                coordinate.bounds = axis.name + "_bnds"
+                if axis.units is not None:
+                    coordinate.units = axis.units
+                if axis.periodic:
+                    coordinate.modulo = axis.mx - axis.mn
+                bounds = nc.createVariable(axis.name + "_bnds", "f8",
+                                           (axis.name, "nv"))
+                edges = axis.edges
+                bounds[:] = np.column_stack([edges[:-1], edges[1:]])
+            for i, name in enumerate(self.variables):
+                empty = count[..., i] == 0
+                for (suffix, field) in [("", mean), ("_variance", variance)]:
+                    variable = nc.createVariable(
+                        name + suffix, "f8", dimensions,
+                        fill_value=netCDF4.default_fillvals["f8"])
+                    variable[:] = np.ma.masked_array(field[..., i], mask=empty)
+                variable = nc.createVariable(name + "_count", "f8", dimensions)
+                variable[:] = count[..., i]
+            nc.number_of_files = len(self.files)
+            if attributes:
+                nc.setncatts(attributes)
@@ -0,0 +1,306 @@
+"""Remapping of fields between latitude/longitude grids.
+
+A Regridder holds a sparse (scipy.sparse CSR) matrix that maps the cells of a
+source grid onto the cells of a target grid, either conservatively (by the area
+of overlap of the cells) or by bilinear interpolation between the cell centres.
+Both grids are rectilinear, so the matrix is the Kronecker product of a
+latitude and a longitude matrix. Matrices are cached in memory and on disk,
+keyed by a hash of the grids, so each pair of grids is only calculated once.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+#the cache directory used if none is given to Regridder
+default_cache_dir = os.environ.get(
+    "DWELL_REGRID_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "dwell", "regrid"))
+
+#the regridding matrices calculated in this process, by grid hash
+_matrices = {}
+
+
+def is_periodic(lon_edges):
+    """Returns True if the longitude edges cover the whole circle"""
+    return np.isclose(abs(lon_edges[-1] - lon_edges[0]), 360.)
+
+
+def ascending(edges):
+    """
+    Returns the edges in ascending order, and the index of each cell of the
+    ascending edges in the original order.
+    """
+    edges = np.asarray(edges, dtype=float)
+    index = np.arange(edges.size - 1)
+    if edges[0] > edges[-1]:
+        return (edges[::-1], index[::-1])
+    return (edges, index)
+
+
+def overlap_matrix(source_edges, target_edges, period=None):
+    """
+    Returns the sparse matrix of the length of the overlap of each target cell
+    (row) with each source cell (column) of two one dimensional grids, given by
+    their cell edges. With period, the source grid is repeated every period
+    (e.g. 360 degrees of longitude).
+
+    :param source_edges: edges of the source cells
+    :type source_edges: numpy 1d
+
+    :param target_edges: edges of the target cells
+    :type target_edges: numpy 1d
+
+    :param period: period of the source grid
+    :type period: float
+
+    :return: overlap of each pair of cells
+    :rtype: scipy.sparse.csr_matrix
+    """
+    import scipy.sparse
+    (source, source_index) = ascending(source_edges)
+    (target, target_index) = ascending(target_edges)
+    ns = source.size - 1
+    if period is not None:
+        #copies of the source grid either side, mapped back onto the source cells
+        source = np.concatenate([source[:-1] - period, source[:-1],
+                                 source + period])
+        source_index = np.tile(source_index, 3)
+    #every piece between consecutive edges of either grid lies in one source
+    #and one target cell (or outside the grids)
+    edges = np.union1d(source, target)
+    middle = (edges[1:] + edges[:-1]) / 2.
+    length = np.diff(edges)
+    s = np.searchsorted(source, middle) - 1
+    t = np.searchsorted(target, middle) - 1
+    inside = (s >= 0) & (s < source.size - 1) & (t >= 0) & (t < target.size - 1)
+    inside &= length > 0
+    return scipy.sparse.csr_matrix(
+        (length[inside], (target_index[t[inside]], source_index[s[inside]])),
+        shape=(target.size - 1, ns))
+
+
+def linear_matrix(source_centres, target_centres, period=None):
+    """
+    Returns the sparse matrix of linear interpolation weights from the source
+    points (columns) to each target point (row) of two one dimensional grids.
+    Targets outside the source points take the value of the closest point,
+    unless the grid is periodic with period.
+
+    :param source_centres: source points
+    :type source_centres: numpy 1d
+
+    :param target_centres: target points
+    :type target_centres: numpy 1d
+
+    :param period: period of the source points
+    :type period: float
+
+    :return: interpolation weights
+    :rtype: scipy.sparse.csr_matrix
+    """
+    import scipy.sparse
+    source = np.asarray(source_centres, dtype=float)
+    target = np.asarray(target_centres, dtype=float)
+    ns = source.size
+    order = np.argsort(source)
+    source = source[order]
+    if period is not None:
+        #wrap the first and last points around, and the targets into range
+        source = np.concatenate([[source[-1] - period], source,
+                                 [source[0] + period]])
+        order = np.concatenate([[order[-1]], order, [order[0]]])
+        target = source[0] + np.mod(target - source[0], period)
+    if source.size == 1:
+        rows = np.arange(target.size)
+        return scipy.sparse.csr_matrix(
+            (np.ones(target.size), (rows, np.zeros(target.size, dtype=int))),
+            shape=(target.size, ns))
+    lower = np.clip(np.searchsorted(source, target) - 1, 0, source.size - 2)
+    fraction = np.clip((target - source[lower]) /
+                       (source[lower + 1] - source[lower]), 0., 1.)
+    rows = np.arange(target.size)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate([1. - fraction, fraction]),
+         (np.concatenate([rows, rows]),
+          np.concatenate([order[lower], order[lower + 1]]))),
+        shape=(target.size, ns))
+
+
+def conservative_matrix(source_lat, source_lon, target_lat, target_lon,
+                        periodic=None):
+    """
+    Returns the sparse matrix of the fraction of the area of each target cell
+    (row) covered by each source cell (column), from the cell edges in degrees.
+    The area of a cell is proportional to dlon*dsin(lat).
+    """
+    import scipy.sparse
+    if periodic is None:
+        periodic = is_periodic(source_lon)
+    lat = overlap_matrix(np.sin(np.radians(source_lat)),
+                         np.sin(np.radians(target_lat)))
+    lat = scipy.sparse.diags(1. / np.abs(np.diff(np.sin(np.radians(target_lat))))) @ lat
+    lon = overlap_matrix(source_lon, target_lon,
+                         period=360. if periodic else None)
+    lon = scipy.sparse.diags(1. / np.abs(np.diff(target_lon))) @ lon
+    return scipy.sparse.kron(lat, lon, format="csr")
+
+
+def bilinear_matrix(source_lat, source_lon, target_lat, target_lon,
+                    periodic=None):
+    """
+    Returns the sparse matrix of the bilinear interpolation weights from the
+    source cell centres to each target cell centre, from the cell edges in degrees.
+    """
+    import scipy.sparse
+    if periodic is None:
+        periodic = is_periodic(source_lon)
+    centres = [(np.asarray(e[1:], dtype=float) + np.asarray(e[:-1], dtype=float)) / 2.
+               for e in [source_lat, source_lon, target_lat, target_lon]]
+    lat = linear_matrix(centres[0], centres[2])
+    lon = linear_matrix(centres[1], centres[3],
+                        period=360. if periodic else None)
+    return scipy.sparse.kron(lat, lon, format="csr")
+
+
+#the regridding methods, by name
+methods = dict(conservative=conservative_matrix, bilinear=bilinear_matrix)
+
+
+def grid_hash(*arrays, **options):
+    """Returns a hash of the grid edges and options that identifies a regridding matrix"""
+    sha = hashlib.sha1()
+    for key in sorted(options):
+        sha.update("{0}={1};".format(key, options[key]).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        sha.update(str(array.shape).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+class Regridder(object):
+    """
+    Remaps fields from one latitude/longitude grid to another, given the cell
+    edges of each grid in degrees. The (sparse) remapping matrix is calculated
+    once for each pair of grids and method, and cached in memory and in
+    cache_dir, so later Regridders of the same grids load it instead.
+    Fields are remapped over their last two (latitude, longitude) axes, with
+    all the leading axes remapped together in a single sparse product.
+
+    Example::
+
+        regrid = Regridder(lat1, lon1, lat2, lon2, method="conservative")
+        coarse = regrid(temperature)  # (time, level, nlat1, nlon1) -> (time, level, nlat2, nlon2)
+
+    :param source_lat: the nlat+1 latitude edges of the source cells
+    :type source_lat: numpy 1d
+
+    :param source_lon: the nlon+1 longitude edges of the source cells
+    :type source_lon: numpy 1d
+
+    :param target_lat: the latitude edges of the target cells
+    :type target_lat: numpy 1d
+
+    :param target_lon: the longitude edges of the target cells
+    :type target_lon: numpy 1d
+
+    :param method: conservative or bilinear
+    :type method: str
+
+    :param periodic: logical to determine if the source longitudes wrap around, by default if they span 360 degrees
+    :type periodic: bool
+
+    :param cache_dir: directory of the cached matrices, DWELL_REGRID_CACHE or ~/.cache/dwell/regrid by default, or False to only cache in memory
+    :type cache_dir: str
+    """
+    def __init__(self, source_lat, source_lon, target_lat, target_lon,
+                 method="conservative", periodic=None, cache_dir=None):
+        if method not in methods:
+            raise ValueError("unknown regridding method {0}, available methods are {1}".format(
+                method, sorted(methods)))
+        if periodic is None:
+            periodic = bool(is_periodic(source_lon))
+        self.method = method
+        self.source_shape = (len(source_lat) - 1, len(source_lon) - 1)
+        self.target_shape = (len(target_lat) - 1, len(target_lon) - 1)
+        self.key = grid_hash(source_lat, source_lon, target_lat, target_lon,
+                             method=method, periodic=periodic)
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        self.cache_file = None
+        if cache_dir:
+            self.cache_file = os.path.join(cache_dir,
+                                           "regrid-{0}.npz".format(self.key))
+        self.matrix = self.load()
+        if self.matrix is None:
+            self.matrix = methods[method](source_lat, source_lon, target_lat,
+                                          target_lon, periodic=periodic)
+            self.save()
+
+    def load(self):
+        """Returns the cached matrix of the grids, or None"""
+        import scipy.sparse
+        if self.key in _matrices:
+            return _matrices[self.key]
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            matrix = scipy.sparse.load_npz(self.cache_file).tocsr()
+            _matrices[self.key] = matrix
+            return matrix
+        return None
+
+    def save(self):
+        """Caches the matrix in memory and, if there's a cache_dir, on disk"""
+        import scipy.sparse
+        _matrices[self.key] = self.matrix
+        if self.cache_file is not None:
+            directory = os.path.dirname(self.cache_file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            #write to a temporary file first, so other processes never read half a file
+            temporary = "{0}.{1}.npz".format(self.cache_file[:-4], os.getpid())
+            scipy.sparse.save_npz(temporary, self.matrix)
+            os.replace(temporary, self.cache_file)
+
+    def __call__(self, field, skipna=False):
+        """
+        Returns the field remapped to the target grid.
+
+        :param field: field with the source grid as its last two axes
+        :type field: numpy array
+
+        :param skipna: logical to determine if NaN source cells are left out, normalising by the weight of the valid cells
+        :type skipna: bool
+
+        :return: field with the target grid as its last two axes
+        :rtype: numpy array
+        """
+        field = np.asarray(field)
+        if field.shape[-2:] != self.source_shape:
+            raise ValueError("field of shape {0} is not on the source grid {1}".format(
+                field.shape, self.source_shape))
+        leading = field.shape[:-2]
+        stack = np.reshape(field, (-1, self.source_shape[0] * self.source_shape[1])).T
+        if skipna:
+            valid = np.isfinite(stack)
+            result = self.matrix @ np.where(valid, stack, 0.)
+            weight = self.matrix @ valid.astype(float)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = np.where(weight > 0, result / weight, np.nan)
+        else:
+            result = self.matrix @ stack
+        return np.reshape(result.T, leading + self.target_shape)
+
+
+def regrid(field, source_lat, source_lon, target_lat, target_lon,
+           method="conservative", skipna=False, **kwargs):
+    """
+    Remaps field from the source to the target latitude/longitude grid, using a
+    (cached) Regridder. See Regridder for the arguments.
+
+    :return: field with the target grid as its last two axes
+    :rtype: numpy array
+    """
+    regridder = Regridder(source_lat, source_lon, target_lat, target_lon,
+                          method=method, **kwargs)
+    return regridder(field, skipna=skipna)
@@ -7,43 +7,78 @@ except Exception as e:
     use_cdms2 = False
 
 
-from ._internal import ifftn, rffttruncate,\
-    npfft, fft_axes, fftshift
+from ._internal import ifftn, fftn, rifftn, rffttruncate,\
+    npfft, fft_axes, fftshift, truncation_indices, truncation_plane, take2,\
+    as_precision, complex_type
+from ._backends import FFTBackend, register_backend, available_backends,\
+    get_backend, set_backend, use_backend, PlanCache, plan_cache,\
+    export_wisdom, import_wisdom
+
+import tempfile
 
 import numpy
 
 
-def spec1d(data, d1, use_axes=0):
+def spec1d(data, d1, use_axes=0, backend=None, dtype=None, real=False,
+           out=None):
     """Calculate the 1 dimensional FFT and return a truncated array.
 
-    :param data: 1-dimensional array of data to FFT
+    Any other dimensions of data are looped over in the same transform,
+    so e.g. the diurnal cycle of every grid column is one call. The work
+    is done on a view with the FFT axis last, so the truncation, scaling,
+    amplitude and phase all run over contiguous series.
+
+    :param data: N-dimensional array of data to FFT
     :type data: numpy array
 
     :param d1: : step size of the data, used to calculate axes data
     :type d1: float
 
+    :param use_axes: the axis to FFT
+    :type use_axes: integer
+
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param dtype: precision to calculate in, e.g. numpy.float32, see
+        spec_numpy
+    :type dtype: numpy dtype
+
+    :param real: use a real-input transform that only computes the half
+        that is kept. The data must be real.
+    :type real: logical
+
+    :param out: optional pair of arrays of the output shape to store the
+        amplitude and phase in
+    :type out: tuple
+
     :return: Amplitude, calculated as the absolute magnitude of the complex FFT
     :return: phase, calculate as atan(imag(ft)/real(ft))
     :return: x axis values
-    :rtype: tuple of (numpy 1d, numpy 1d, numpy 1d)
+    :rtype: tuple of (numpy nd, numpy nd, numpy 1d)
     """
-    internal_use_axes = list([use_axes])
-    ft = ifftn(data, internal_use_axes)
-    n = ft.shape[internal_use_axes[0]]
+    axis = numpy.ravel(use_axes)[0] % numpy.ndim(data)
+    n = data.shape[axis]
     f1 = npfft.fftfreq(n, d1)
     f1 = abs(rffttruncate(f1, 0))
-    ft = rffttruncate(ft, internal_use_axes[0])
-    # double amplitude and correct 0, 0
-    ft = ft*2.0
-
-    # build the slice accessor to half the zeroth bin
-    sl = [slice(None)]*ft.ndim
-    sl[use_axes] = 0
-    ft[sl] = ft[sl]*0.5
+    # move the FFT axis last (a view), and move it back at the end
+    data = numpy.moveaxis(data, axis, -1)
+    if real:
+        ft = rifftn(data, [-1], -1, backend=backend, dtype=dtype)
+    else:
+        ft = ifftn(data, [-1], backend=backend, dtype=dtype)
+        # rffttruncate as a single gather with a cached index
+        ft = numpy.take(ft, truncation_indices(n, 1)[0], axis=-1)
+    # double amplitude and correct 0
+    ft *= 2
+    ft[..., 0] *= 0.5
 
-    amp = numpy.abs(ft)
-    pha = numpy.arctan2(numpy.imag(ft), numpy.real(ft))
-    return (amp, pha, f1)
+    if out is None:
+        out = (None, None)
+    out = [None if o is None else numpy.moveaxis(o, axis, -1) for o in out]
+    amp = numpy.abs(ft, out=out[0])
+    pha = numpy.arctan2(numpy.imag(ft), numpy.real(ft), out=out[1])
+    return (numpy.moveaxis(amp, -1, axis), numpy.moveaxis(pha, -1, axis), f1)
 
 
 def axis_or_axes(data, axis=None, axes=None, *args, **kwargs):
@@ -64,7 +99,111 @@ def axis_or_axes(data, axis=None, axes=None, *args, **kwargs):
     return r
 
 
-def truncate_fft(ft, d1, d2, use_axes, atmosphere=None, ocean=None):
+def detrend_field(data, use_axes, detrend=None, perturb=None):
+    """Remove the trend along the first FFT axis and/or the mean along the other.
+
+    :param data: The data to detrend
+    :type data: numpy array
+
+    :param use_axes: two element axes list of the FFT axes
+    :type use_axes: list
+
+    :param detrend: remove the trend along use_axes[0] (time). True or
+        'linear' removes a linear fit, 'constant' the mean.
+    :type detrend: logical or string
+
+    :param perturb: remove the trend along use_axes[1]. True or
+        'constant' removes the mean (perturbation from the zonal mean),
+        'linear' a linear fit.
+    :type perturb: logical or string
+
+    :return: detrended data, or data itself if neither flag is set
+    :rtype: numpy array
+    """
+    if not detrend and not perturb:
+        return data
+    import scipy.signal
+    if detrend:
+        data = scipy.signal.detrend(
+            data, axis=use_axes[0],
+            type="linear" if detrend is True else detrend)
+    if perturb:
+        data = scipy.signal.detrend(
+            data, axis=use_axes[1],
+            type="constant" if perturb is True else perturb)
+    return data
+
+
+def truncation_axis(use_axes, atmosphere=None, ocean=None):
+    """Return the axis that is truncated to half its length.
+
+    :param use_axes: two element axes list describing which axes are
+                being used in the FFT
+    :type use_axes: list
+
+    :param atmosphere: bool to decide to use 'atmosphere'
+                truncation (f1 positive definite)
+    :type atmosphere: logical
+
+    :param ocean: bool to decide to use 'ocean'
+                truncation (f2 positive definite)
+    :type ocean: logical
+
+    :return: the element of use_axes to truncate
+    :rtype: integer
+    """
+    ao = False
+    if atmosphere is not None:
+        ao = True
+    elif ocean is not None:
+        ao = not ocean
+
+    if ao:
+        return use_axes[0]
+    else:
+        return use_axes[1]
+
+
+def spectral_axes(shape, d1, d2, use_axes, atmosphere=None, ocean=None):
+    """Calculate the axes of a truncated spectrum.
+
+    :param shape: shape of the untruncated transform
+    :type shape: tuple
+
+    :param d1: dimension along the X axis
+    :type d1: float
+
+    :param d2: dimension along the Y axis
+    :type d2: float
+
+    :param use_axes: two element axes list of the FFT axes
+    :type use_axes: list
+
+    :param atmosphere: bool to decide to use 'atmosphere' truncation
+    :type atmosphere: logical
+
+    :param ocean: bool to decide to use 'ocean' truncation
+    :type ocean: logical
+
+    :return: tuple of axes1, axes2 as returned by truncate_fft
+    :rtype: 1d numpy, 1d numpy
+    """
+    (f1, f2) = fft_axes(None, d1, d2, use_axes, shape=shape)
+    if truncation_axis(use_axes, atmosphere, ocean) == use_axes[0]:
+        # atmosphere
+        # for atmosphere, wave (d1, f1) is positive definite
+        # which means freq (d2, f2) can be negative
+        f1 = -rffttruncate(f1, 0)
+        f2 = fftshift(f2, 0)
+    else:
+        # ocean
+        f2 = -rffttruncate(f2, 0)
+        f1 = fftshift(f1, 0)
+    return (f1, f2)
+
+
+def truncate_fft(ft, d1, d2, use_axes, atmosphere=None, ocean=None,
+                 shape=None, double=True):
     """Truncate a Complex 2d FFT plane to half the size in one dimension.
 
     Removing negative exponents
@@ -94,56 +233,71 @@ def truncate_fft(ft, d1, d2, use_axes, atmosphere=None, ocean=None):
                 truncation (f2 positive definite)
     :type ocean: logical
 
+    :param shape: shape of the untruncated transform. If given, ft is
+                assumed to be truncated already (e.g. by rifftn) and
+                only the axes, scaling and shift are applied.
+    :type shape: tuple
+
+    :param double: double the amplitude of all but the (0, 0) element to
+                account for the discarded half. If False the truncated
+                plane is returned unscaled, see double_amplitude.
+    :type double: logical
+
     :return: tuple of complex truncated fft, axes1, axes2
     :rtype: 2d numpy, 1d numpy, 1d numpy
     """
-    ao = False
-    if atmosphere is not None:
-        ao = True
-    elif ocean is not None:
-        ao = not ocean
+    truncated = shape is not None
+    if shape is None:
+        shape = ft.shape
+    # the plane order below compares the axes, so make them all positive
+    use_axes = [a % ft.ndim for a in use_axes]
+    (f1, f2) = spectral_axes(shape, d1, d2, use_axes, atmosphere, ocean)
+    it = truncation_axis(use_axes, atmosphere, ocean)
+    ishift = use_axes[1] if it == use_axes[0] else use_axes[0]
+
+    # the truncation and the shift are both permutations, so gather the
+    # final half plane in one pass using index arrays cached per shape
+    indices = truncation_indices(shape[it], shape[ishift], truncated)
+    flat = truncation_plane(shape[it], shape[ishift], truncated,
+                            ishift < it)
+    ft = take2(ft, [it, ishift], indices, flat)
+    if double:
+        double_amplitude(ft, use_axes, atmosphere, ocean)
 
-    (f1, f2) = fft_axes(ft, d1, d2, use_axes)
-    if ao:
-        # atmosphere
-        # for atmosphere, wave (d1, f1) is positive definite
-        # which means freq (d2, f2) can be negative
+    return (ft, f1, f2)
 
-        f1 = -rffttruncate(f1, 0)
-        ft = rffttruncate(ft, use_axes[0])
-        # double amplitude and correct 0, 0
-        ft = ft*2.0
-        # build the slice accessor to half the zeroth bin
-        sl = [slice(None)]*ft.ndim
-        for u in use_axes:
-            sl[u] = 0
 
-        ft[sl] = ft[sl]*0.5
+def double_amplitude(ft, use_axes, atmosphere=None, ocean=None):
+    """Double a truncated FFT plane in place, except the (0, 0) element.
 
-        f2 = fftshift(f2, 0)
-        ft = fftshift(ft, use_axes[1])
+    :param ft: truncated and shifted FFT'd data, from truncate_fft
+    :type ft: numpy array
 
-        pass
-    else:
-        # ocean
+    :param use_axes: two element axes list of the FFT axes
+    :type use_axes: list
 
-        f2 = -rffttruncate(f2, 0)
-        ft = rffttruncate(ft, use_axes[1])
-        ft = ft*2.0
-        # build the slice accessor to half the zeroth bin
-        sl = [slice(None)]*ft.ndim
-        for u in use_axes:
-            sl[u] = 0
-
-        ft[sl] = ft[sl]*0.5
-        f1 = fftshift(f1, 0)
-        ft = fftshift(ft, use_axes[0])
-        pass
+    :param atmosphere: bool to decide to use 'atmosphere' truncation
+    :type atmosphere: logical
 
-    return (ft, f1, f2)
+    :param ocean: bool to decide to use 'ocean' truncation
+    :type ocean: logical
+
+    :return: ft
+    :rtype: numpy array
+    """
+    it = truncation_axis(use_axes, atmosphere, ocean)
+    ishift = use_axes[1] if it == use_axes[0] else use_axes[0]
+    # double amplitude and correct 0, 0, which the shift has moved
+    ft *= 2
+    sl = [slice(None)]*ft.ndim
+    sl[it] = 0
+    sl[ishift] = ft.shape[ishift]//2
+    ft[tuple(sl)] *= 0.5
+    return ft
 
 
-def fft_core(field1, field2=None, use_axes=None):
+def fft_core(field1, field2=None, use_axes=None, truncate_axis=None,
+             backend=None, dtype=None):
     """Call the FFT core interface given data and axes to transform over.
 
     :param field1: dataset 1, must contain at least the axes listed in use_axes
@@ -157,23 +311,48 @@ def fft_core(field1, field2=None, use_axes=None):
     :param use_axes: axes over which to FFT.
     :type use_axes: list
 
+    :param truncate_axis: optional axis in use_axes along which the
+                    fields are real-transformed, returning only the half
+                    of that axis kept by rffttruncate. The fields must be real.
+    :type truncate_axis: integer
+
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param dtype: precision to transform in, see ifftn
+    :type dtype: numpy dtype
+
     :return: The fft'd field, or the cospectrum field
     :rtype: 2d numpy array
     """
-    ft = ifftn(field1, use_axes)
+    if truncate_axis is None:
+        def transform(field, axes):
+            return ifftn(field, axes, backend=backend, dtype=dtype)
+    else:
+        def transform(field, axes):
+            return rifftn(field, axes, truncate_axis, backend=backend,
+                          dtype=dtype)
+
+    ft = transform(field1, use_axes)
 # cospectrum optional
     if field2 is not None:
-        ft2 = ifftn(field2, use_axes)
-        ft = ft*numpy.conj(ft2)
+        ft2 = transform(field2, use_axes)
+        ft *= numpy.conj(ft2)
 
     return ft
 
 
 def spec(_data, d1, d2, *args, **kwargs):
-    """Interface to spec_cdms or spec_numpy.
+    """Interface to spec_cdms, spec_numpy or spec_outofcore.
 
-    Wrap the result appropriately.
+    Wrap the result appropriately. Arrays that are not numpy arrays but
+    can be sliced (netCDF4 variables), or any array with outofcore=True
+    (e.g. a numpy.memmap), are streamed through spec_outofcore.
     """
+    if kwargs.pop("outofcore", False) or (
+            not isinstance(_data, numpy.ndarray) and
+            hasattr(_data, "shape") and hasattr(_data, "__getitem__")):
+        return spec_outofcore(_data, d1, d2, *args, **kwargs)
     if use_cdms2:
         if isinstance(_data, cdms2.tvariable.TransientVariable):
             return spec_cdms2(_data, d1, d2, *args, **kwargs)
@@ -184,6 +363,168 @@ def spec(_data, d1, d2, *args, **kwargs):
             return spec_numpy(_data, d1, d2, *args, **kwargs)
 
 
+def scratch_array(shape, dtype, scratch=None):
+    """Create an array backed by an anonymous file instead of memory.
+
+    The file is deleted as soon as it is created (where the operating
+    system allows it), so the space is freed when the array is.
+
+    :param shape: shape of the array
+    :type shape: tuple
+
+    :param dtype: type of the array
+    :type dtype: numpy dtype
+
+    :param scratch: directory for the file, default the system temporary
+        directory
+    :type scratch: string
+
+    :return: array
+    :rtype: numpy.memmap
+    """
+    size = max(int(numpy.prod(shape)), 1)*numpy.dtype(dtype).itemsize
+    f = tempfile.TemporaryFile(dir=scratch)
+    f.truncate(size)
+    return numpy.memmap(f, dtype=dtype, mode="w+", shape=tuple(shape))
+
+
+def spec_outofcore(_data, d1, d2, axis=None, axes=None,
+                   detrend=None, perturb=None,
+                   atmosphere=None, ocean=None, field2=None,
+                   backend=None, out=None, scratch=None, max_memory=2**28,
+                   dtype=None, real=None, chunksize=None, threads=None):
+    """Calculate spec_numpy of a field too large for memory.
+
+    The field (a netCDF4 variable, numpy.memmap, or anything that can be
+    sliced into numpy arrays) is read in slabs. The first pass real
+    transforms each slab along the truncated axis into a scratch array on
+    disk, the second pass transforms the scratch array along the other
+    axis in slabs, and writes the shifted amplitude and phase into the
+    outputs. Masked values are filled with zero.
+
+    :param _data: The data to transform
+    :type _data: netCDF4 variable
+
+    :param d1, d2, axis, axes, atmosphere, ocean, field2, backend:
+        see spec_numpy
+
+    :param detrend, perturb: see spec_numpy. perturb needs a third axis
+        to slab along. Without one, detrend is done in a separate pass
+        that keeps the whole of axes[0] in each slab.
+
+    :param out: pair of output arrays, default arrays on disk created by
+        scratch_array
+    :type out: tuple
+
+    :param scratch: directory for the scratch and output files
+    :type scratch: string
+
+    :param max_memory: approximate number of bytes of a complex slab
+    :type max_memory: integer
+
+    :param dtype: precision to calculate in, see spec_numpy
+    :type dtype: numpy dtype
+
+    :param real, chunksize, threads: spec_numpy keywords, ignored. The
+        transform is always the real-input one, in slabs.
+
+    :return: as spec_numpy
+    :rtype: tuple of (numpy, numpy, numpy 1d, numpy 1d)
+    """
+    data = _data
+    shape = tuple(data.shape)
+    ndim = len(shape)
+    use_axes = [a % ndim for a in (axis or axes or [ndim-2, ndim-1])]
+    it = truncation_axis(use_axes, atmosphere, ocean)
+    ishift = use_axes[1] if it == use_axes[0] else use_axes[0]
+    loop_axes = [a for a in range(ndim) if a not in use_axes]
+    backend = get_backend(backend)
+    (f1, f2) = spectral_axes(shape, d1, d2, use_axes, atmosphere, ocean)
+
+    n = shape[it]
+    half = list(shape)
+    half[it] = n//2 + 1
+    if dtype is None:
+        ctype = complex_type(data.dtype)
+    else:
+        ctype = complex_type(numpy.finfo(dtype).dtype)
+    rtype = numpy.finfo(ctype).dtype
+    itemsize = numpy.dtype(ctype).itemsize
+
+    def slabs(slab_shape, slab_axis):
+        # slices of at most max_memory bytes (as complex) along slab_axis
+        per_index = itemsize*int(numpy.prod(slab_shape))//slab_shape[slab_axis]
+        step = max(1, int(max_memory)//max(per_index, 1))
+        for start in range(0, slab_shape[slab_axis], step):
+            sl = [slice(None)]*ndim
+            sl[slab_axis] = slice(start, start + step)
+            yield tuple(sl)
+
+    # pass 1, slab along an axis that keeps the truncated axis whole
+    if loop_axes:
+        axis1 = loop_axes[0]
+    else:
+        if perturb:
+            raise ValueError("perturb needs a third axis to slab along")
+        axis1 = ishift
+
+    # a detrend along axes[0] needs all of it, so if pass 1 splits it,
+    # detrend first in slabs along axes[1] into a scratch array
+    separate = detrend and axis1 == use_axes[0]
+
+    def detrended(field):
+        result = scratch_array(shape, rtype, scratch)
+        for sl in slabs(shape, use_axes[1]):
+            slab = as_precision(numpy.ma.filled(field[sl], 0.0), rtype)
+            result[sl] = detrend_field(slab, use_axes, detrend)
+        return result
+
+    def forward(field):
+        ft = scratch_array(half, ctype, scratch)
+        if separate:
+            field = detrended(field)
+        for sl in slabs(shape, axis1):
+            slab = numpy.ma.filled(field[sl], 0.0)
+            slab = as_precision(slab, rtype)
+            slab = detrend_field(slab, use_axes,
+                                 None if separate else detrend,
+                                 perturb if loop_axes else None)
+            ft_slab = backend.rfft(slab, it).astype(ctype, copy=False)
+            ft_slab /= n
+            ft[sl] = ft_slab
+        return ft
+
+    ft1 = forward(data)
+    ft2 = None if field2 is None else forward(field2)
+
+    if out is None:
+        out = (scratch_array(half, rtype, scratch),
+               scratch_array(half, rtype, scratch))
+    (a, b) = out
+    # pass 2, slab along an axis that keeps the shifted axis whole
+    axis2 = loop_axes[0] if loop_axes else it
+    ishift_index = truncation_indices(n, shape[ishift], True)[1]
+    for sl in slabs(half, axis2):
+        ft = backend.ifftn(ft1[sl], [ishift])
+        if ft2 is not None:
+            ft *= numpy.conj(backend.ifftn(ft2[sl], [ishift]))
+        ft = numpy.take(ft, ishift_index, axis=ishift)
+        # double amplitude and correct 0, 0 if this slab holds it
+        ft *= 2
+        if axis2 != it or sl[it].start == 0:
+            zero = [slice(None)]*ndim
+            zero[it] = 0
+            zero[ishift] = shape[ishift]//2
+            ft[tuple(zero)] *= 0.5
+        if ft2 is None:
+            numpy.abs(ft, out=a[sl])
+            numpy.arctan2(ft.imag, ft.real, out=b[sl])
+        else:
+            a[sl] = ft.real
+            b[sl] = ft.imag
+    return (a, b, f1, f2)
+
+
 def spec_cdms2(_data, d1, d2, *args, **kwargs):
     """Call the fft spec_numpy function.
 
@@ -226,7 +567,9 @@ def spec_cdms2(_data, d1, d2, *args, **kwargs):
 def spec_numpy(_data, d1, d2,
                axis=None, axes=None,
                detrend=None, perturb=None,
-               atmosphere=None, ocean=None, field2=None
+               atmosphere=None, ocean=None, field2=None,
+               real=False, backend=None,
+               chunksize=None, threads=None, out=None, dtype=None
                ):
     """Routine transforms a real field to frequency/zonal wavenumber space.
 
@@ -256,12 +599,12 @@ def spec_numpy(_data, d1, d2,
     :param axis: alternate name for axes
     :type axis: list
 
-    :param detrend: boolean to determine whether the data is first
-        detrended over some axis NOT USED
+    :param detrend: whether the data (and field2) is first detrended
+        along axes[0], see detrend_field
     :type detrend: logical
 
-    :param perturb: boolean to determine whether the data is first
-     detrended over the other axis NOT USED
+    :param perturb: whether the data (and field2) is first detrended
+        along axes[1], see detrend_field
     :type perturb: logical
 
     :param atmosphere: booleans to determine the axis to truncate
@@ -272,31 +615,193 @@ def spec_numpy(_data, d1, d2,
 
     :param field2: optional argument to flag a cospectrum calculation.
     :type field2: float
+
+    :param real: use a real-input transform that only computes the half
+        plane kept after truncation. The result is the same, for roughly
+        half the work and memory. The data must be real.
+    :type real: logical
+
+    :param backend: FFT backend name or instance, see get_backend.
+        Defaults to the backend set by set_backend or use_backend.
+    :type backend: string
+
+    :param chunksize: transform the axes that are not FFT'd in chunks of
+        this many elements along the first of them, see spec_batched
+    :type chunksize: integer
+
+    :param threads: number of threads used to transform the chunks,
+        see spec_batched
+    :type threads: integer
+
+    :param out: optional pair of arrays of the output shape to store the
+        amplitude and phase (or cospectrum and quadrature) in
+    :type out: tuple
+
+    :param dtype: floating point precision to calculate in. numpy.float32
+        gives a single precision pipeline: the data is cast (chunk by chunk
+        with chunksize), transformed as complex64, and amplitude and phase
+        are float32. Compared with the double precision pipeline the
+        amplitudes agree to about 1e-6 of the largest amplitude. If None,
+        the precision follows the data, so float32 data stays single
+        precision. The axes are always float64.
+    :type dtype: numpy dtype
     """
     data = _data
     # which axes?
-    use_axes = axis_or_axes(data, axis, axes)
-    # calculate the fft over n dimensions
-    ft = fft_core(data, field2=field2, use_axes=use_axes)
-    # calculate axis and truncate
-    ft, f1, f2 = truncate_fft(ft, d1, d2, use_axes, atmosphere, ocean)
-
+    use_axes = [a % data.ndim for a in axis_or_axes(data, axis, axes)]
+    if chunksize is not None or threads is not None:
+        return spec_batched(data, d1, d2, use_axes,
+                            chunksize=chunksize, threads=threads,
+                            detrend=detrend, perturb=perturb,
+                            atmosphere=atmosphere, ocean=ocean,
+                            field2=field2, real=real, backend=backend,
+                            out=out, dtype=dtype)
+    data = detrend_field(as_precision(data, dtype), use_axes,
+                         detrend, perturb)
+    if field2 is not None:
+        field2 = detrend_field(as_precision(field2, dtype), use_axes,
+                               detrend, perturb)
+    if real:
+        # only calculate the half of the plane that is kept
+        ft = fft_core(data, field2=field2, use_axes=use_axes,
+                      truncate_axis=truncation_axis(use_axes,
+                                                    atmosphere, ocean),
+                      backend=backend)
+        ft, f1, f2 = truncate_fft(ft, d1, d2, use_axes, atmosphere, ocean,
+                                  shape=data.shape)
+    else:
+        # calculate the fft over n dimensions
+        ft = fft_core(data, field2=field2, use_axes=use_axes,
+                      backend=backend)
+        # calculate axis and truncate
+        ft, f1, f2 = truncate_fft(ft, d1, d2, use_axes, atmosphere, ocean)
+
+    if out is None:
+        out = (None, None)
     if field2 is None:
         # amplitude spec
-        amp = numpy.abs(ft)
-        pha = numpy.arctan2(numpy.imag(ft), numpy.real(ft))
+        amp = numpy.abs(ft, out=out[0])
+        pha = numpy.arctan2(numpy.imag(ft), numpy.real(ft), out=out[1])
         return (amp, pha, f1, f2)
     else:
         # cospectrum
         cospec = numpy.real(ft)
         quad = numpy.imag(ft)
+        if out[0] is not None:
+            out[0][...] = cospec
+            cospec = out[0]
+        if out[1] is not None:
+            out[1][...] = quad
+            quad = out[1]
         return (cospec, quad, f1, f2)
 
 
+def spec_batched(_data, d1, d2, use_axes, chunksize=None, threads=None,
+                 chunk_axis=None, field2=None, backend=None, out=None,
+                 **kwargs):
+    """Calculate spec_numpy in chunks along an axis that is not FFT'd.
+
+    Each chunk of chunksize elements along chunk_axis is transformed
+    separately, optionally by a pool of threads, and written into
+    preallocated outputs. Only the chunks being transformed are held as
+    complex arrays, so a (time, level, lat, lon) field can be decomposed
+    with bounded memory.
+
+    :param _data: The data to transform
+    :type _data: numpy array
+
+    :param d1: axis 1 step size
+    :type d1: float
+
+    :param d2: axis 2 step size
+    :type d2: float
+
+    :param use_axes: the two axes over which to FFT
+    :type use_axes: list
+
+    :param chunksize: number of elements along chunk_axis per chunk,
+        defaults to splitting the axis evenly between the threads
+    :type chunksize: integer
+
+    :param threads: number of threads, default 1
+    :type threads: integer
+
+    :param chunk_axis: axis to split, defaults to the first axis not in
+        use_axes
+    :type chunk_axis: integer
+
+    :param field2: optional second field for a cospectrum, same shape
+    :type field2: numpy array
+
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param out: optional pair of output arrays, see spec_numpy
+    :type out: tuple
+
+    Other keyword arguments (atmosphere, ocean, real) are passed to
+    spec_numpy.
+
+    :return: as spec_numpy
+    :rtype: tuple of (numpy, numpy, numpy 1d, numpy 1d)
+    """
+    data = _data
+    use_axes = [a % data.ndim for a in use_axes]
+    loop_axes = [a for a in range(data.ndim) if a not in use_axes]
+    # the backend scope (use_backend) is per thread, so resolve it here
+    backend = get_backend(backend)
+    if not loop_axes:
+        return spec_numpy(data, d1, d2, axes=use_axes, field2=field2,
+                          backend=backend, out=out, **kwargs)
+    if chunk_axis is None:
+        chunk_axis = loop_axes[0]
+    if chunk_axis % data.ndim in use_axes:
+        raise ValueError("chunk_axis {0} is one of the FFT axes {1}".format(
+            chunk_axis, use_axes))
+    threads = threads or 1
+    n = data.shape[chunk_axis]
+    if chunksize is None:
+        chunksize = -(-n // threads)
+
+    def chunk(start):
+        sl = [slice(None)]*data.ndim
+        sl[chunk_axis] = slice(start, start + chunksize)
+        return tuple(sl)
+
+    def transform(start, out=None):
+        f2 = None if field2 is None else field2[chunk(start)]
+        return spec_numpy(data[chunk(start)], d1, d2, axes=use_axes,
+                          field2=f2, backend=backend, out=out, **kwargs)
+
+    # the first chunk gives the output shapes, axes and types
+    starts = list(range(0, n, chunksize))
+    (a, p, f1, f2) = transform(starts[0])
+    if out is None:
+        shape = list(a.shape)
+        shape[chunk_axis] = n
+        out = (numpy.empty(shape, a.dtype), numpy.empty(shape, p.dtype))
+    (amp, pha) = out
+    amp[chunk(starts[0])] = a
+    pha[chunk(starts[0])] = p
+
+    def store(start):
+        # write straight into the outputs
+        transform(start, out=(amp[chunk(start)], pha[chunk(start)]))
+
+    if threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(store, starts[1:]))
+    else:
+        for start in starts[1:]:
+            store(start)
+    return (amp, pha, f1, f2)
+
+
 def cospec(_data, field2, d1, d2,
            axis=None, axes=None,
            detrend=None, perturb=None,
-           atmosphere=None, ocean=None
+           atmosphere=None, ocean=None, real=False, backend=None, dtype=None
            ):
     """Calculate the cospectrum as fft(_data)*conj(fft(field2)).
 
@@ -313,14 +818,305 @@ def cospec(_data, field2, d1, d2,
 
     :param axes: axis over which to fft
     :param axis: alternate name for axes
-    :param detrend: boolean to determine whether the data is
-     first detrended over some axis NOT USED
-    :param perturb: boolean to determine whether the data is
-     first detrended over the other axis NOT USED
+    :param detrend: whether the data is first detrended along axes[0]
+    :param perturb: whether the data is first detrended along axes[1]
     :param atmosphere, ocean: booleans to determine the axis to truncate.
+    :param real: use the real-input transform, see spec_numpy
+    :param backend: FFT backend name or instance, see get_backend
+    :param dtype: precision to calculate in, see spec_numpy
     """
     return spec(_data, d1, d2,
                 axis=axis, axes=axes,
                 detrend=detrend, perturb=perturb,
-                atmosphere=atmosphere, ocean=ocean, field2=field2
+                atmosphere=atmosphere, ocean=ocean, field2=field2,
+                real=real, backend=backend, dtype=dtype
                 )
+
+
+def spec_welch(_data, d1, d2, nperseg, noverlap=None, window="hann",
+               axis=None, axes=None,
+               detrend="linear", perturb=None,
+               atmosphere=None, ocean=None, field2=None,
+               real=False, backend=None, dtype=None
+               ):
+    """Calculate a segment averaged (Welch) space-time power spectrum.
+
+    The data is split into segments of nperseg steps along axes[0] (time),
+    overlapping by noverlap steps. Each segment is detrended, tapered by
+    the window and transformed, and the power (or the cospectrum and
+    quadrature spectrum, if field2 is given) is averaged over segments.
+    The segments are a strided view of the data and are transformed
+    together in one batched FFT.
+
+    :param _data: The data to transform
+    :type _data: numpy array
+
+    :param d1: axis 1 (time) step size
+    :type d1: float
+
+    :param d2: axis 2 step size
+    :type d2: float
+
+    :param nperseg: length of each segment along axes[0]
+    :type nperseg: integer
+
+    :param noverlap: overlap of the segments, default nperseg/2
+    :type noverlap: integer
+
+    :param window: taper applied to each segment along axes[0], a window
+        name or tuple for scipy.signal.get_window, an array of length
+        nperseg, or None
+    :type window: string
+
+    :param axes: axis over which to fft
+    :type axes: list
+
+    :param axis: alternate name for axes
+    :type axis: list
+
+    :param detrend: detrending of each segment along axes[0], see
+        detrend_field
+    :type detrend: logical or string
+
+    :param perturb: detrending of the data along axes[1], see
+        detrend_field
+    :type perturb: logical or string
+
+    :param atmosphere: booleans to determine the axis to truncate
+    :type atmosphere: logical
+
+    :param ocean: booleans to determine the axis to truncate
+    :type ocean: logical
+
+    :param field2: optional second field for the cross spectrum
+    :type field2: numpy array
+
+    :param real: use the real-input transform, see spec_numpy
+    :type real: logical
+
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param dtype: precision to calculate in, see spec_numpy
+    :type dtype: numpy dtype
+
+    :return: power, axes1, axes2, or with field2 the averaged
+        cospectrum, quadrature spectrum, axes1, axes2. The power is
+        normalized by the mean square of the window.
+    :rtype: tuple of numpy arrays
+    """
+    data = _data
+    use_axes = [a % data.ndim for a in axis_or_axes(data, axis, axes)]
+    t = use_axes[0]
+
+    def segments(field):
+        return welch_segments(as_precision(field, dtype), use_axes, nperseg,
+                              noverlap, window, detrend, perturb)
+
+    (seg1, seg_axes, scale) = segments(data)
+    seg2 = None if field2 is None else segments(field2)[0]
+    (a, b, f1, f2) = spec_numpy(seg1, d1, d2, axes=seg_axes,
+                                atmosphere=atmosphere, ocean=ocean,
+                                field2=seg2, real=real, backend=backend)
+    # average over the segments, and put the time axis back in place
+    if field2 is None:
+        a *= a
+        power = numpy.moveaxis(numpy.mean(a, axis=t)*scale, -1, t)
+        return (power, f1, f2)
+    else:
+        cospec = numpy.moveaxis(numpy.mean(a, axis=t)*scale, -1, t)
+        quad = numpy.moveaxis(numpy.mean(b, axis=t)*scale, -1, t)
+        return (cospec, quad, f1, f2)
+
+
+def welch_segments(data, use_axes, nperseg, noverlap=None, window="hann",
+                   detrend="linear", perturb=None):
+    """Split data into tapered, overlapping segments along use_axes[0].
+
+    The segments are taken as a strided view of the data, with the segment
+    number along use_axes[0] and the steps within each segment along a
+    new last axis, then detrended and multiplied by the window.
+
+    :param data: The data to split
+    :type data: numpy array
+
+    :param use_axes: two element axes list of the FFT axes
+    :type use_axes: list
+
+    :param nperseg, noverlap, window, detrend, perturb: see spec_welch
+
+    :return: segments, the FFT axes of the segments, and the normalization
+        of the power by the mean square of the window
+    :rtype: tuple of (numpy array, list, float)
+    """
+    (t, x) = [a % data.ndim for a in use_axes]
+    if noverlap is None:
+        noverlap = nperseg//2
+    step = nperseg - noverlap
+    if nperseg > data.shape[t] or step < 1:
+        raise ValueError("Need noverlap < nperseg <= {0}".format(
+            data.shape[t]))
+
+    if window is None:
+        taper = numpy.ones(nperseg)
+    elif isinstance(window, numpy.ndarray):
+        taper = window
+    else:
+        import scipy.signal
+        taper = scipy.signal.get_window(window, nperseg)
+    # a python float, and a taper of the data type, keep float32 segments
+    # in single precision
+    scale = float(1.0/numpy.mean(taper**2))
+    taper = taper.astype(numpy.finfo(complex_type(data)).dtype, copy=False)
+
+    seg_axes = [data.ndim, x]
+    sl = [slice(None)]*data.ndim
+    sl[t] = slice(None, None, step)
+
+    # sliding_window_view needs numpy 1.20, so only import it when it's used
+    from numpy.lib.stride_tricks import sliding_window_view
+    field = detrend_field(data, [t, x], None, perturb)
+    field = sliding_window_view(field, nperseg, axis=t)[tuple(sl)]
+    field = detrend_field(field, seg_axes, detrend)
+    return (field*taper, seg_axes, scale)
+
+
+def cross_spectra(fields, d1, d2, axis=None, axes=None, pairs=None,
+                  nperseg=None, noverlap=None, window="hann",
+                  average_axes=None, detrend=None, perturb=None,
+                  atmosphere=None, ocean=None, real=False, backend=None,
+                  cache=None, dtype=None
+                  ):
+    """Yield the cross spectra of pairs of fields, transforming each field once.
+
+    The cospectrum and quadrature spectrum of a pair are the same as
+    cospec(field1, field2), but each field is transformed (and truncated)
+    only once however many pairs it is in, so all K*K pairs of K fields
+    cost K transforms. Pairs are yielded one at a time, so only the K
+    transforms and the current pair are held in memory.
+
+    Coherence and phase need an average: over segments (nperseg, as
+    spec_welch) and/or over average_axes (axes that are not FFT'd).
+    Without either, the coherence is 1 wherever it is defined.
+
+    :param fields: the fields to cross, all the same shape
+    :type fields: dict of numpy arrays
+
+    :param d1: axis 1 step size
+    :type d1: float
+
+    :param d2: axis 2 step size
+    :type d2: float
+
+    :param axes: axis over which to fft
+    :type axes: list
+
+    :param axis: alternate name for axes
+    :type axis: list
+
+    :param pairs: list of (name1, name2) to calculate. Default all pairs
+        with name1 <= name2 in the order of fields, including each field
+        with itself. (name2, name1) has the same cospectrum and coherence,
+        and the negated quadrature spectrum and phase.
+    :type pairs: list
+
+    :param nperseg, noverlap, window: segment averaging, see spec_welch
+    :param average_axes: axes (not FFT'd) to average over
+    :type average_axes: list
+
+    :param detrend, perturb: see spec_numpy, or spec_welch with nperseg.
+        By default the fields are not detrended, as cospec, but with
+        nperseg the segments are detrended linearly, as spec_welch
+        (pass detrend=False to leave them).
+    :param atmosphere, ocean: booleans to determine the axis to truncate
+    :param real: use the real-input transform, see spec_numpy
+    :param backend: FFT backend name or instance, see get_backend
+
+    :param cache: optional dict that holds the transform of each field,
+        keyed by name. Transforms already in it are reused, so it can be
+        passed to later calls with the same fields and options.
+    :type cache: dict
+
+    :param dtype: precision to calculate in, see spec_numpy
+    :type dtype: numpy dtype
+
+    :return: generator of (name1, name2, cospectrum, quadrature,
+        coherence squared, phase, axes1, axes2) for each pair
+    :rtype: generator
+    """
+    names = list(fields)
+    if pairs is None:
+        pairs = [(names[i], names[j]) for i in range(len(names))
+                 for j in range(i, len(names))]
+    if cache is None:
+        cache = dict()
+    backend = get_backend(backend)
+    data = fields[names[0]]
+    use_axes = [a % data.ndim for a in axis_or_axes(data, axis, axes)]
+    t = use_axes[0]
+    average = set(a % data.ndim for a in (average_axes or []))
+    if nperseg is not None and detrend is None:
+        detrend = "linear"
+    if nperseg is None:
+        seg_axes = use_axes
+        scale = 1.0
+    else:
+        average.add(t)
+        seg_axes = [data.ndim, use_axes[1]]
+    average = tuple(sorted(average))
+
+    def transform(name):
+        if name in cache:
+            return cache[name]
+        field = as_precision(fields[name], dtype)
+        if nperseg is None:
+            field = detrend_field(field, use_axes, detrend, perturb)
+        else:
+            field = welch_segments(field, use_axes, nperseg, noverlap,
+                                   window, detrend, perturb)[0]
+        if real:
+            ft = fft_core(field, use_axes=seg_axes, backend=backend,
+                          truncate_axis=truncation_axis(seg_axes,
+                                                        atmosphere, ocean))
+            cache[name] = truncate_fft(ft, d1, d2, seg_axes, atmosphere,
+                                       ocean, shape=field.shape,
+                                       double=False)
+        else:
+            ft = fft_core(field, use_axes=seg_axes, backend=backend)
+            cache[name] = truncate_fft(ft, d1, d2, seg_axes, atmosphere,
+                                       ocean, double=False)
+        return cache[name]
+
+    if nperseg is not None:
+        scale = welch_segments(data, use_axes, nperseg, noverlap,
+                               window)[2]
+        # where the time axis goes after averaging
+        position = t - len([a for a in average if a < t])
+
+    def reduce(product):
+        double_amplitude(product, seg_axes, atmosphere, ocean)
+        if average:
+            product = numpy.mean(product, axis=average)
+        product = product*scale
+        if nperseg is not None:
+            product = numpy.moveaxis(product, -1, position)
+        return product
+
+    powers = dict()
+
+    def power(name):
+        if name not in powers:
+            ft = transform(name)[0]
+            powers[name] = reduce(numpy.real(ft*numpy.conj(ft)))
+        return powers[name]
+
+    for (name1, name2) in pairs:
+        (ft1, f1, f2) = transform(name1)
+        ft2 = transform(name2)[0]
+        cross = reduce(ft1*numpy.conj(ft2))
+        cospec = numpy.real(cross)
+        quad = numpy.imag(cross)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            coherence = (cospec**2 + quad**2)/(power(name1)*power(name2))
+        phase = numpy.arctan2(quad, cospec)
+        yield (name1, name2, cospec, quad, coherence, phase, f1, f2)
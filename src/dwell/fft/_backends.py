@@ -0,0 +1,576 @@
+"""FFT backend registry. Wraps anfft, scipy.fft, scipy.fftpack, pyFFTW and numpy.fft.
+
+Each engine is an FFTBackend instance registered by name. The default
+engine is chosen at import time in the order anfft, scipy.fftpack, numpy
+(as before), or from the DWELL_FFT_BACKEND environment variable, and can
+be changed with set_backend or scoped with the use_backend context manager.
+
+Transforms are run through plans, kept in a bounded least-recently-used
+cache (plan_cache) keyed on backend, shape, dtype, axes and direction.
+FFTW wisdom can be saved with export_wisdom and loaded with import_wisdom.
+"""
+
+import collections
+import contextlib
+import functools
+import os
+import pickle
+import threading
+
+import numpy
+import numpy.fft as npfft
+
+
+class FFTBackend(object):
+    """Base class of an FFT engine.
+
+    Subclasses define the library module name, and _ifftn/_fftn methods
+    that call the library with a list of axes. If the library can only
+    transform the trailing dimensions (anfft), set transpose=True and the
+    data is transposed so that the axes to transform are last.
+    """
+
+    name = None
+    module = None
+    transpose = False
+
+    def __init__(self, **options):
+        self.options = options
+        self._library = None
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, self.name)
+
+    @property
+    def library(self):
+        """Import (once) and return the library module."""
+        if self._library is None:
+            self._library = __import__(self.module, fromlist=["_"])
+        return self._library
+
+    def available(self):
+        """Return True if the library can be imported.
+
+        :rtype: logical
+        """
+        try:
+            self.library
+        except ImportError:
+            return False
+        return True
+
+    def _ifftn(self, data, axes):
+        raise NotImplementedError
+
+    def _fftn(self, data, axes):
+        raise NotImplementedError
+
+    def _rfft(self, data, axes):
+        return npfft.rfft(data, axis=axes[0])
+
+    def plan(self, shape, dtype, axes, direction):
+        """Return a function that transforms arrays of this shape and dtype.
+
+        The base class simply binds the library call. Backends with real
+        plans (pyfftw) build them here. Called by plan_cache on a miss.
+
+        :param shape: shape of the data
+        :type shape: tuple
+
+        :param dtype: dtype of the data
+        :type dtype: numpy dtype
+
+        :param axes: axes to transform
+        :type axes: tuple
+
+        :param direction: 'ifftn', 'fftn' or 'rfft'
+        :type direction: string
+
+        :return: function taking the data and returning the transform
+        :rtype: function
+        """
+        function = getattr(self, "_" + direction)
+        return functools.partial(function, axes=axes)
+
+    def export_wisdom(self):
+        """Return the planner wisdom of the library, or None."""
+        return None
+
+    def import_wisdom(self, wisdom):
+        """Load planner wisdom from export_wisdom."""
+        pass
+
+    def _execute(self, direction, data, axes):
+        # the numpy rfft fallback handles any axis, so never transpose it
+        transpose = self.transpose and axes is not None and \
+            direction != "rfft"
+        if transpose:
+            # transpose the array so that the fft dims are all at the end
+            data = trans_forward(data, axes)
+            k = numpy.size(axes)
+            run_axes = tuple(range(data.ndim - k, data.ndim))
+        else:
+            run_axes = None if axes is None else tuple(axes)
+        plan = plan_cache.get(self, data.shape, data.dtype, run_axes,
+                              direction)
+        ft = plan(data)
+        if transpose:
+            # transpose back
+            ft = trans_backward(ft, axes)
+        return ft
+
+    def ifftn(self, data, axes=None):
+        """Run the inverse FFT over the axes (all axes if None).
+
+        :param data: The data to transform
+        :type data: numpy array
+
+        :param axes: The axes over which to FFT
+        :type axes: list
+
+        :return: An FFTd array
+        :rtype: numpy array
+        """
+        return self._execute("ifftn", data, axes)
+
+    def fftn(self, data, axes=None):
+        """Run the forward FFT over the axes (all axes if None).
+
+        :param data: The data to transform
+        :type data: numpy array
+
+        :param axes: The axes over which to FFT
+        :type axes: list
+
+        :return: An FFTd array
+        :rtype: numpy array
+        """
+        return self._execute("fftn", data, axes)
+
+    def rfft(self, data, axis):
+        """Run the forward FFT of real data along one axis.
+
+        Only the non-negative frequencies are returned (N/2+1 of them).
+        Backends without a numpy-compatible rfft use numpy.fft.
+
+        :param data: The real data to transform
+        :type data: numpy array
+
+        :param axis: The axis over which to FFT
+        :type axis: integer
+
+        :return: An FFTd array
+        :rtype: numpy array
+        """
+        return self._execute("rfft", data, [axis])
+
+
+class NumpyBackend(FFTBackend):
+    """numpy.fft engine."""
+
+    name = "numpy"
+    module = "numpy.fft"
+
+    def _ifftn(self, data, axes):
+        return self.library.ifftn(data, axes=axes)
+
+    def _fftn(self, data, axes):
+        return self.library.fftn(data, axes=axes)
+
+
+class ScipyFFTPackBackend(FFTBackend):
+    """scipy.fftpack engine."""
+
+    name = "scipy"
+    module = "scipy.fftpack"
+
+    def _ifftn(self, data, axes):
+        return self.library.ifftn(data, axes=axes)
+
+    def _fftn(self, data, axes):
+        return self.library.fftn(data, axes=axes)
+
+
+class ScipyFFTBackend(FFTBackend):
+    """scipy.fft engine, multithreaded with the workers option.
+
+    :param workers: number of threads, -1 for all cores
+    :type workers: integer
+    """
+
+    name = "scipy.fft"
+    module = "scipy.fft"
+
+    def _ifftn(self, data, axes):
+        return self.library.ifftn(data, axes=axes,
+                                  workers=self.options.get("workers"))
+
+    def _fftn(self, data, axes):
+        return self.library.fftn(data, axes=axes,
+                                 workers=self.options.get("workers"))
+
+    def _rfft(self, data, axes):
+        return self.library.rfft(data, axis=axes[0],
+                                 workers=self.options.get("workers"))
+
+
+class PyFFTWBackend(FFTBackend):
+    """pyFFTW engine, with FFTW plans built once per shape and cached.
+
+    Each thread that runs a cached plan gets its own FFTW object (built
+    quickly from the wisdom of the first), so threads run concurrently.
+
+    :param threads: number of threads
+    :type threads: integer
+
+    :param planner_effort: FFTW planner flag, default 'FFTW_MEASURE'
+    :type planner_effort: string
+    """
+
+    name = "pyfftw"
+    module = "pyfftw"
+
+    def plan(self, shape, dtype, axes, direction):
+        builders = __import__("pyfftw.builders", fromlist=["_"])
+        builder = getattr(builders, direction)
+        if direction == "rfft":
+            kwargs = dict(axis=axes[0])
+        else:
+            kwargs = dict(axes=axes)
+
+        def build():
+            return builder(numpy.empty(shape, dtype),
+                           threads=self.options.get("threads", 1),
+                           planner_effort=self.options.get("planner_effort",
+                                                           "FFTW_MEASURE"),
+                           **kwargs)
+        # plan now, so that the FFTW objects of other threads are built
+        # from the wisdom of this one
+        local = threading.local()
+        local.fftw = build()
+
+        def execute(data):
+            # the FFTW object owns its arrays, so each thread has its own,
+            # and the result is copied out before the next call overwrites it
+            fftw = getattr(local, "fftw", None)
+            if fftw is None:
+                fftw = local.fftw = build()
+            return fftw(data).copy()
+        return execute
+
+    def export_wisdom(self):
+        return self.library.export_wisdom()
+
+    def import_wisdom(self, wisdom):
+        self.library.import_wisdom(wisdom)
+
+
+class AnfftBackend(FFTBackend):
+    """anfft engine, uses 'measure' optimization.
+
+    anfft only transforms the trailing dimensions, so the data is
+    transposed before and after the transform.
+    """
+
+    name = "anfft"
+    module = "anfft"
+    transpose = True
+
+    def _ifftn(self, data, axes):
+        if axes is None:
+            return self.library.ifftn(data, measure=True)
+        return self.library.ifftn(data, len(axes), measure=True)
+
+    def _fftn(self, data, axes):
+        if axes is None:
+            return self.library.fftn(data, measure=True)
+        return self.library.fftn(data, len(axes), measure=True)
+
+
+class PlanCache(object):
+    """Least-recently-used cache of FFT plans.
+
+    Plans are keyed on (backend, backend options, shape, dtype, axes,
+    direction) and created with FFTBackend.plan on a miss. When more
+    than maxsize plans are held, the least recently used is dropped.
+
+    :param maxsize: maximum number of plans
+    :type maxsize: integer
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._plans)
+
+    @staticmethod
+    def key(backend, shape, dtype, axes, direction):
+        """Return the cache key of a transform."""
+        options = tuple(sorted(backend.options.items()))
+        if axes is not None:
+            axes = tuple(axes)
+        return (backend.name, options, tuple(shape), numpy.dtype(dtype).str,
+                axes, direction)
+
+    def get(self, backend, shape, dtype, axes, direction):
+        """Return the plan for a transform, creating it if needed.
+
+        :param backend: the engine
+        :type backend: FFTBackend
+
+        :return: function taking the data and returning the transform
+        :rtype: function
+        """
+        key = self.key(backend, shape, dtype, axes, direction)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self.hits += 1
+                self._plans.pop(key)
+                self._plans[key] = plan
+                return plan
+            self.misses += 1
+        plan = backend.plan(tuple(shape), numpy.dtype(dtype), axes, direction)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > max(self.maxsize, 0):
+                self._plans.popitem(last=False)
+        return plan
+
+    def keys(self):
+        """Return the keys of the cached plans, oldest first."""
+        with self._lock:
+            return list(self._plans)
+
+    def info(self):
+        """Return a dict of hits, misses, size and maxsize."""
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._plans), maxsize=self.maxsize)
+
+    def clear(self):
+        """Drop all plans and reset the counters."""
+        with self._lock:
+            self._plans.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+plan_cache = PlanCache()
+
+
+_registry = {}
+_default = [None]
+_scope = threading.local()
+
+
+def register_backend(backend):
+    """Add an FFTBackend instance to the registry, replacing any of the same name.
+
+    :param backend: the engine
+    :type backend: FFTBackend
+    """
+    _registry[backend.name] = backend
+
+
+def available_backends():
+    """Return the names of the registered backends that can be imported.
+
+    :return: backend names
+    :rtype: list
+    """
+    return [name for name in sorted(_registry)
+            if _registry[name].available()]
+
+
+def _make_backend(name, **options):
+    if isinstance(name, FFTBackend):
+        if options:
+            return type(name)(**options)
+        return name
+    if name not in _registry:
+        raise ValueError("Unknown FFT backend {0}, choose from {1}".format(
+            name, sorted(_registry)))
+    backend = _registry[name]
+    if options:
+        backend = type(backend)(**options)
+    if not backend.available():
+        raise ImportError("FFT backend {0} is not available".format(name))
+    return backend
+
+
+def get_backend(name=None):
+    """Return the FFTBackend to use.
+
+    :param name: backend name or instance. If None, the backend set by the
+                 innermost use_backend, or else the default backend.
+    :type name: string
+
+    :return: the engine
+    :rtype: FFTBackend
+    """
+    if name is None:
+        name = getattr(_scope, "backend", None)
+        if name is None:
+            return _default[0]
+    return _make_backend(name)
+
+
+def set_backend(name, **options):
+    """Set the default backend, with engine options (e.g. workers=8).
+
+    :param name: backend name or instance
+    :type name: string
+
+    :return: the engine
+    :rtype: FFTBackend
+    """
+    _default[0] = _make_backend(name, **options)
+    return _default[0]
+
+
+@contextlib.contextmanager
+def use_backend(name, **options):
+    """Use a backend within a with block, in this thread only.
+
+    :param name: backend name or instance
+    :type name: string
+
+    Example::
+
+        with use_backend("scipy.fft", workers=-1):
+            amp, pha, f1, f2 = spec(data, d1, d2)
+    """
+    previous = getattr(_scope, "backend", None)
+    _scope.backend = _make_backend(name, **options)
+    try:
+        yield _scope.backend
+    finally:
+        _scope.backend = previous
+
+
+def export_wisdom(filename):
+    """Save planner wisdom, and the list of cached plans, to a file.
+
+    A worker process can load the file with import_wisdom to start with
+    the plans already made.
+
+    :param filename: file to write
+    :type filename: string
+    """
+    wisdom = dict()
+    for name in available_backends():
+        w = _registry[name].export_wisdom()
+        if w is not None:
+            wisdom[name] = w
+    with open(filename, "wb") as f:
+        pickle.dump(dict(wisdom=wisdom, plans=plan_cache.keys()), f,
+                    protocol=2)
+
+
+def import_wisdom(filename, build=True):
+    """Load planner wisdom saved by export_wisdom.
+
+    :param filename: file to read
+    :type filename: string
+
+    :param build: also create the plans that were cached when the file
+                  was written, for the backends available here
+    :type build: logical
+    """
+    with open(filename, "rb") as f:
+        saved = pickle.load(f)
+    for name, wisdom in saved["wisdom"].items():
+        if name in _registry and _registry[name].available():
+            _registry[name].import_wisdom(wisdom)
+    if not build:
+        return
+    for (name, options, shape, dtype, axes, direction) in saved["plans"]:
+        if name not in _registry or not _registry[name].available():
+            continue
+        backend = _registry[name]
+        if options:
+            backend = type(backend)(**dict(options))
+        plan_cache.get(backend, shape, dtype, axes, direction)
+
+
+def trans_array(data, _axes):
+    """Calculate indices for an array transpose use by anFFT.
+
+    :param data: The data, used for dimension purposes (rank)
+    :type data: numpy array
+    :param _axes: axes to FFT over, and hence transpose to the end
+    :type _axes: list
+    :return: tuple of axes values
+    :rtype: tuple of integers
+
+    """
+    ind = list(range(data.ndim))
+    try:
+        axes = list(_axes)
+    except Exception:  # integer
+        axes = [_axes]
+    axes.sort()
+    axes.reverse()
+    for a in axes:
+        ind.pop(a)
+    ind.extend(axes)
+    return ind
+
+
+def trans_forward(data, _axes):
+    """Transpose an array to the correct order for anfft.
+
+    :param data: The data to be transposed
+    :type data: numpy array
+
+    :param _axes: axes to FFT, and hence transpose
+    :type _axes: list
+
+    :return: The transposed array
+    :rtype: numpy array
+    """
+    ind = trans_array(data, _axes)
+    # ind now contains the transposed dimensions
+    return numpy.transpose(data, ind)
+
+
+def trans_backward(data, _axes):
+    """Reverse the transpose of an array to the correct order for anfft.
+
+    :param data: The data to transpose
+    :type data: numpy array
+
+    :param _axes: The axes over which to FFT, and transpose if anfft is used
+    :type _axes: list
+
+    :return: The transposed array
+    :rtype: numpy array
+    """
+    ind = trans_array(data, _axes)
+    ind2 = list(ind)
+    for d in ind:
+        ind2[d] = ind.index(d)
+    # ind now contains the reverse transposed dimensions
+    return numpy.transpose(data, ind2)
+
+
+for _backend in [AnfftBackend(), ScipyFFTBackend(), ScipyFFTPackBackend(),
+                 PyFFTWBackend(), NumpyBackend()]:
+    register_backend(_backend)
+
+# Try to get an FFT library in order of anfft, scipy.fftpack, numpy.fft
+# we require numpy for everything else, so the last check shouldn't fail?
+if os.environ.get("DWELL_FFT_BACKEND"):
+    set_backend(os.environ["DWELL_FFT_BACKEND"])
+else:
+    for _name in ["anfft", "scipy", "numpy"]:
+        if _registry[_name].available():
+            set_backend(_name)
+            break
+    else:
+        raise ImportError("Error: Cannot use fft libraries")
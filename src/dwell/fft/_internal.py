@@ -1,67 +1,76 @@
-"""Interal fft code. Interfaces to anfft, numpy.fft or scipy.fft for fft."""
+"""Interal fft code. Interfaces to the FFT backends for fft."""
+
+import functools
 
 import numpy
 import numpy.fft as npfft
 
-got_fft_library = False
-using_fft_library = None
+from ._backends import get_backend, trans_array, trans_forward, \
+    trans_backward
 
-# Try to get an FFT library in order of anfft, scipy.fftpack, numpy.fft
-# we require numpy for everything else, so the last check shouldn't fail?
+# name of the default library, kept for backwards compatibility.
+# Use dwell.fft.get_backend() to find the engine actually in use.
+using_fft_library = get_backend().name
 
-if not got_fft_library:
-    try:
-        import anfft as fft
-        got_fft_library = True
-        using_fft_library = "anfft"
-    except ImportError:
-        got_fft_library = False
 
-if not got_fft_library:
-    try:
-        import scipy.fftpack as fft
-        got_fft_library = True
-        using_fft_library = "scipy"
-    except ImportError:
-        got_fft_library = False
+fftshift = npfft.fftshift
 
-if not got_fft_library:
-    try:
-        import numpy.fft as fft
-        got_fft_library = True
-        using_fft_library = "numpy"
-    except ImportError:
-        got_fft_library = False
 
-if not got_fft_library:
-    raise ImportError("Error: Cannot use fft libraries")
+def fft_ifftn(data, axes=None, backend=None):
+    """Call the backend function ifftn (inverse).
 
+    If the anfft library is used, enable 'measure' optimization.
 
-fftshift = npfft.fftshift
+    """
+    return get_backend(backend).ifftn(data, axes)
 
 
-def fft_ifftn(*args, **kwargs):
-    """Call the core fft library function ifftn (inverse).
+def fft_fftn(data, axes=None, backend=None):
+    """Call the backend function fftn.
 
     If the anfft library is used, enable 'measure' optimization.
 
     """
-    if using_fft_library == "anfft":
-        return fft.ifftn(*args, measure=True, **kwargs)
-    else:
-        return fft.ifftn(*args, **kwargs)
+    return get_backend(backend).fftn(data, axes)
 
 
-def fft_fftn(*args, **kwargs):
-    """Call the core fft library function fftn.
+def as_precision(data, dtype=None):
+    """Cast data to a floating point precision, keeping it real or complex.
 
-    If the anfft library is used, enable 'measure' optimization.
+    :param data: The data to cast
+    :type data: numpy array
+
+    :param dtype: real or complex type giving the precision, e.g.
+                  numpy.float32 or numpy.complex64 for single precision.
+                  If None the data is returned unchanged.
+    :type dtype: numpy dtype
 
+    :return: data, or a copy of it in the new precision
+    :rtype: numpy array
     """
-    if using_fft_library == "anfft":
-        return fft.fftn(*args, measure=True, **kwargs)
-    else:
-        return fft.fftn(*args, **kwargs)
+    if dtype is None:
+        return data
+    rtype = numpy.finfo(dtype).dtype
+    if numpy.iscomplexobj(data):
+        rtype = numpy.result_type(rtype, numpy.complex64)
+    return data.astype(rtype, copy=False)
+
+
+def complex_type(data):
+    """Return the complex type with the precision of data.
+
+    float32 (and smaller) floating point data gives complex64, everything
+    else, including integers, complex128 (or longer).
+
+    :param data: The data, or its dtype
+    :type data: numpy array
+
+    :rtype: numpy dtype
+    """
+    dtype = numpy.dtype(getattr(data, "dtype", data))
+    if dtype.kind not in "fc":
+        return numpy.dtype(numpy.complex128)
+    return numpy.result_type(dtype, numpy.complex64)
 
 
 def odd(n):
@@ -92,22 +101,12 @@ def rffttruncate(ft, axis):
     :return: Truncated data
     :rtype: numpy array
 
-    This function shifts (rolls) the data along the correct axis,
-    calculates a slice range which is either (N-1)/2 or N/2-1.
+    This function keeps element 0, then the negative frequencies in
+    reverse order, n//2+1 elements in all, the same as truncation_indices.
 
     """
-    ft2 = numpy.roll(ft, -1, axis)
-    d = []
-    for i in range(ft.ndim):
-        d.append(slice(None, None, None))
-
-    n = ft2.shape[axis]
-    if odd(n):
-        x = int((n-1)/2)
-    else:
-        x = int(n/2-1)
-    d[axis] = slice(-1, x-1, -1)
-    return ft2[d]
+    it = truncation_indices(ft.shape[axis], 1)[0]
+    return numpy.take(ft, it, axis=axis)
 
 
 def ffttruncate(ft, axis):
@@ -136,7 +135,108 @@ def ffttruncate(ft, axis):
     else:
         x = int(n/2)
     d[axis] = slice(None, x, None)
-    return ft[d]
+    return ft[tuple(d)]
+
+
+@functools.lru_cache(maxsize=64)
+def truncation_indices(n_truncate, n_shift, truncated=False):
+    """Calculate the index arrays that truncate one axis and shift another.
+
+    Indexing the truncated axis with the first array is the same as
+    rffttruncate (element 0, then the negative frequencies in reverse),
+    and indexing the other axis with the second array is the same as
+    fftshift. The arrays are cached per shape.
+
+    :param n_truncate: length of the axis to truncate
+    :type n_truncate: integer
+
+    :param n_shift: length of the axis to shift
+    :type n_shift: integer
+
+    :param truncated: the axis to truncate has already been truncated
+                      (e.g. by rifftn), so its index array is the identity
+    :type truncated: logical
+
+    :return: index arrays for the truncated axis and the shifted axis
+    :rtype: tuple of (numpy 1d, numpy 1d)
+    """
+    n = n_truncate//2 + 1
+    if truncated:
+        it = numpy.arange(n)
+    else:
+        it = -numpy.arange(n) % n_truncate
+    ishift = npfft.fftshift(numpy.arange(n_shift))
+    it.flags.writeable = False
+    ishift.flags.writeable = False
+    return (it, ishift)
+
+
+@functools.lru_cache(maxsize=64)
+def truncation_plane(n_truncate, n_shift, truncated=False, shift_first=False):
+    """Calculate the flat index into a plane that truncates and shifts it.
+
+    Combines the two arrays of truncation_indices into one index into the
+    flattened (n_truncate, n_shift) plane, or (n_shift, n_truncate) plane
+    if shift_first. The arrays are cached per shape.
+
+    :return: flat index array
+    :rtype: numpy 1d
+    """
+    (it, ishift) = truncation_indices(n_truncate, n_shift, truncated)
+    if truncated:
+        n_truncate = it.size
+    if shift_first:
+        flat = ishift[:, numpy.newaxis]*n_truncate + it[numpy.newaxis, :]
+    else:
+        flat = it[:, numpy.newaxis]*n_shift + ishift[numpy.newaxis, :]
+    flat = flat.ravel()
+    flat.flags.writeable = False
+    return flat
+
+
+def take2(data, axes, indices, flat=None):
+    """Gather data along two axes in a single pass.
+
+    Equivalent to numpy.take along each axis in turn, without the
+    intermediate copy.
+
+    :param data: The data to index
+    :type data: numpy array
+
+    :param axes: the two axes to index
+    :type axes: list
+
+    :param indices: one index array for each axis
+    :type indices: list
+
+    :param flat: optional equivalent index into the flattened plane of
+                 the two axes, in increasing axis order. Used when the
+                 axes are adjacent and the plane is contiguous, which
+                 keeps the result in C order.
+    :type flat: numpy 1d
+
+    :return: The gathered array
+    :rtype: numpy array
+    """
+    (a, b) = [x % data.ndim for x in axes]
+    (ia, ib) = indices
+    if a > b:
+        (a, b, ia, ib) = (b, a, ib, ia)
+    shape = data.shape
+    if flat is not None and b - a == 1 and \
+            data.strides[a] == shape[b]*data.strides[b]:
+        merged = data.reshape(shape[:a] + (-1,) + shape[b+1:])
+        result = numpy.take(merged, flat, axis=a)
+        return result.reshape(shape[:a] + (ia.size, ib.size) + shape[b+1:])
+    if b - a == 1:
+        # adjacent index arrays keep their place in the result
+        sl = [slice(None)]*data.ndim
+        sl[a] = ia[:, numpy.newaxis]
+        sl[b] = ib[numpy.newaxis, :]
+        return data[tuple(sl)]
+    view = numpy.moveaxis(data, [a, b], [-2, -1])
+    result = view[..., ia[:, numpy.newaxis], ib[numpy.newaxis, :]]
+    return numpy.moveaxis(result, [-2, -1], [a, b])
 
 
 def fftshift(ft, axis):
@@ -157,7 +257,7 @@ def fftshift(ft, axis):
     return npfft.fftshift(ft, axis)
 
 
-def fft_axes(ft, d1, d2, axis):
+def fft_axes(ft, d1, d2, axis, shape=None):
     """Use numpy to generate the axes because on step size and length.
 
     :param ft: Input fft'd data, used only for the dimension data
@@ -168,42 +268,23 @@ def fft_axes(ft, d1, d2, axis):
     :type d2: float
     :param axis: axis indexes of dimensions
     :type axis: list
+    :param shape: shape of the untruncated transform, used instead of
+                  ft.shape when ft has already been truncated
+    :type shape: tuple
 
     :return: tuple of axes values
     :rtype: tuple of integers
     """
-    n = ft.shape[axis[0]]
+    if shape is None:
+        shape = ft.shape
+    n = shape[axis[0]]
     f1 = npfft.fftfreq(n, d1)
-    n = ft.shape[axis[1]]
+    n = shape[axis[1]]
     f2 = npfft.fftfreq(n, d2)
 
     return (f1, f2)
 
 
-def trans_array(data, _axes):
-    """Calculate indices for an array transpose use by anFFT.
-
-    :param data: The data, used for dimension purposes (rank)
-    :type data: numpy array
-    :param _axes: axes to FFT over, and hence transpose to the end
-    :type _axes: list
-    :return: tuple of axes values
-    :rtype: tuple of integers
-
-    """
-    ind = list(range(data.ndim))
-    try:
-        axes = list(_axes)
-    except Exception:  # integer
-        axes = [_axes]
-    axes.sort()
-    axes.reverse()
-    for a in axes:
-        ind.pop(a)
-    ind.extend(axes)
-    return ind
-
-
 def rtrans_array(data, _axes):
     """Calculate the indices to reverse the transpose of an array after anFFT.
 
@@ -223,48 +304,42 @@ def rtrans_array(data, _axes):
     return rind
 
 
-def trans_forward(data, _axes):
-    """Transpose an array to the correct order for anfft.
-
-    :param data: The data to be transposed
-    :type data: numpy array
-
-    :param _axes: axes to FFT, and hence transpose
-    :type _axes: list
-
-    :return: The transposed array
-    :rtype: numpy array
-    """
-    ind = trans_array(data, _axes)
-    # ind now contains the transposed dimensions
-    return numpy.transpose(data, ind)
-
-
-def trans_backward(data, _axes):
-    """Reverse the transpose of an array to the correct order for anfft.
+def ifftn(data, axes=None, function=None, backend=None, dtype=None):
+    """Run the inverse FFT function over multiple axes.
 
     :param data: The data to transpose
     :type data: numpy array
 
-    :param _axes: The axes over which to FFT, and transpose if anfft is used
-    :type _axes: list
+    :param axes: The axes over which to FFT, and transpose if anfft is used
+    :type axes: numpy array
 
     :param function: ifft function, or fft function if overridden
     :type function: function pointer
 
-    :return: The transposed array
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param dtype: precision to transform in, see as_precision. The
+                  result keeps the precision of the (cast) data, even
+                  with libraries that promote single precision.
+    :type dtype: numpy dtype
+
+    :return: An FFTd array
     :rtype: numpy array
+
     """
-    ind = trans_array(data, _axes)
-    ind2 = list(ind)
-    for d in ind:
-        ind2[d] = ind.index(d)
-    # ind now contains the reverse transposed dimensions
-    return numpy.transpose(data, ind2)
+    if function is None:
+        function = fft_ifftn
 
+    if axes is not None and numpy.ndim(axes) == 0:
+        axes = [axes]
+    data = as_precision(data, dtype)
+    ft = function(data, axes, backend=backend)
+    return ft.astype(complex_type(data), copy=False)
 
-def ifftn(data, axes=None, function=None):
-    """Run the inverse FFT function over multiple axes.
+
+def fftn(data, axes=None, backend=None, dtype=None):
+    """Run the forward FFT function over multiple axes.
 
     :param data: The data to transpose
     :type data: numpy array
@@ -272,60 +347,53 @@ def ifftn(data, axes=None, function=None):
     :param axes: The axes over which to FFT, and transpose if anfft is used
     :type axes: numpy array
 
-    :param function: ifft function, or fft function if overridden
-    :type function: function pointer
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param dtype: precision to transform in, see ifftn
+    :type dtype: numpy dtype
 
     :return: An FFTd array
     :rtype: numpy array
-
     """
-    if function is None:
-        function = fft_ifftn
+    return ifftn(data, axes, fft_fftn, backend=backend, dtype=dtype)
 
-    if axes is None:
-        return function(data)
-    else:
-        if using_fft_library == "anfft":
-            # transpose the array so that the fft dims are all at the end
-            data = trans_forward(data, axes)
-            # fft
-            if type(axes) is list:
-                k = len(axes)
-            elif type(axes) is numpy.ndarray:
-                k = axes.size
-            elif type(axes) is int:
-                k = 1
-            ft = function(data, k)
-            # transpose back
-            data = trans_backward(data, axes)
-            ft = trans_backward(ft, axes)
-
-            pass
-        elif using_fft_library == "scipy":
-            ft = function(data, axes=axes)
-            pass
-        elif using_fft_library == "numpy":
-            ft = function(data, axes=axes)
-            pass
-        else:
-            print("Error: Can't get here")
-
-        return ft
-
-
-def fftn(data, axes=None):
-    """Run the inverse FFT function over multiple axes.
 
-    :param data: The data to transpose
+def rifftn(data, axes, truncate_axis, backend=None, dtype=None):
+    """Run the inverse FFT of real data, keeping half of the truncated axis.
+
+    Equivalent to rffttruncate(ifftn(data, axes), truncate_axis), but the
+    half plane that rffttruncate throws away is never computed. The real
+    input is transformed forward along truncate_axis with rfft, which
+    gives the positive frequencies of the forward transform, i.e. the
+    negative frequencies of the inverse transform in the order that
+    rffttruncate returns them. The remaining axes are then inverse
+    transformed as usual.
+
+    :param data: The real data to transform
     :type data: numpy array
 
-    :param axes: The axes over which to FFT, and transpose if anfft is used
-    :type axes: numpy array
+    :param axes: The axes over which to FFT
+    :type axes: list
 
-    :param function: ifft function, or fft function if overridden
-    :type function: function
+    :param truncate_axis: The axis to truncate, must be one of axes
+    :type truncate_axis: integer
 
-    :return: An FFTd array
+    :param backend: FFT backend name or instance, see get_backend
+    :type backend: string
+
+    :param dtype: precision to transform in, see ifftn
+    :type dtype: numpy dtype
+
+    :return: An FFTd array, truncated along truncate_axis
     :rtype: numpy array
     """
-    return ifftn(data, axes, fft_fftn)
+    backend = get_backend(backend)
+    data = as_precision(data, dtype)
+    ctype = complex_type(data)
+    other_axes = [a for a in axes if a != truncate_axis]
+    ft = backend.rfft(data, truncate_axis).astype(ctype, copy=False)
+    ft /= data.shape[truncate_axis]
+    if other_axes:
+        ft = backend.ifftn(ft, other_axes).astype(ctype, copy=False)
+    return ft
@@ -0,0 +1,321 @@
+from dwell.testing import Testing
+import dwell.fft as fft
+import numpy
+
+
+class test_fft(object):
+    def __init__(self):
+        """Initialize variables used to test fft library
+
+        Creates a random 3D field (and a second field for cospectra) with
+        odd and even lengths along the transformed axes.
+        """
+        self.test = Testing()
+        rs = numpy.random.RandomState(42)
+        self.field1 = rs.rand(3, 8, 11)
+        self.field2 = rs.rand(3, 8, 11)
+        self.d1 = 0.5
+        self.d2 = 2.0
+        self.truncations = [dict(),
+                            dict(atmosphere=True),
+                            dict(ocean=True)]
+
+    def same_spectrum(self, a, b):
+        """Compare two (amp, pha, f1, f2) tuples, phase modulo 2pi"""
+        assert a[0].shape == b[0].shape
+        assert numpy.allclose(a[0], b[0])
+        assert numpy.allclose(numpy.exp(1j*a[1]), numpy.exp(1j*b[1]))
+        assert numpy.allclose(a[2], b[2])
+        assert numpy.allclose(a[3], b[3])
+
+    def test_real(self):
+        """Real-input spec matches the full complex transform"""
+        self.test.debug("spec real")
+        for kw in self.truncations:
+            for axes in [None, [2, 0]]:
+                full = fft.spec(self.field1, self.d1, self.d2,
+                                axes=axes, **kw)
+                real = fft.spec(self.field1, self.d1, self.d2,
+                                axes=axes, real=True, **kw)
+                self.same_spectrum(full, real)
+
+    def test_cospec_real(self):
+        """Real-input cospec matches the full complex transform"""
+        self.test.debug("cospec real")
+        for kw in self.truncations:
+            full = fft.cospec(self.field1, self.field2, self.d1, self.d2, **kw)
+            real = fft.cospec(self.field1, self.field2, self.d1, self.d2,
+                              real=True, **kw)
+            for a, b in zip(full, real):
+                assert numpy.allclose(a, b)
+
+    def test_backends(self):
+        """Every available backend gives the same spectrum"""
+        self.test.debug("backends")
+        default = fft.get_backend()
+        target = fft.spec(self.field1, self.d1, self.d2)
+        for name in fft.available_backends():
+            with fft.use_backend(name) as backend:
+                assert fft.get_backend() is backend
+                result = fft.spec(self.field1, self.d1, self.d2)
+                self.same_spectrum(target, result)
+            assert fft.get_backend() is default
+            result = fft.spec(self.field1, self.d1, self.d2, backend=name)
+            self.same_spectrum(target, result)
+
+    def test_plan_cache(self):
+        """Repeated spectra of one shape reuse the cached plans"""
+        self.test.debug("plan cache")
+        cache = fft.PlanCache(maxsize=2)
+        backend = fft.get_backend()
+        plan = cache.get(backend, (4, 8), numpy.float64, (0, 1), "ifftn")
+        assert cache.get(backend, (4, 8), numpy.float64, (0, 1),
+                         "ifftn") is plan
+        cache.get(backend, (4, 8), numpy.float32, (0, 1), "ifftn")
+        cache.get(backend, (4, 8), numpy.float64, (1,), "ifftn")
+        info = cache.info()
+        assert info["hits"] == 1 and info["misses"] == 3
+        assert info["size"] == 2
+
+        fft.plan_cache.clear()
+        fft.spec(self.field1, self.d1, self.d2)
+        misses = fft.plan_cache.info()["misses"]
+        fft.spec(self.field1, self.d1, self.d2)
+        assert fft.plan_cache.info()["misses"] == misses
+        assert fft.plan_cache.info()["hits"] > 0
+
+        # the cached plans are rebuilt from the saved wisdom
+        import os
+        import tempfile
+        keys = fft.plan_cache.keys()
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            fft.export_wisdom(filename)
+            fft.plan_cache.clear()
+            fft.import_wisdom(filename)
+            info = fft.plan_cache.info()
+            assert info["size"] == len(keys) and info["misses"] == len(keys)
+            assert fft.plan_cache.keys() == keys
+            fft.spec(self.field1, self.d1, self.d2)
+            assert fft.plan_cache.info()["misses"] == len(keys)
+            fft.plan_cache.clear()
+            fft.import_wisdom(filename, build=False)
+            assert len(fft.plan_cache) == 0
+        finally:
+            os.remove(filename)
+
+    def test_batched(self):
+        """Chunked and threaded spectra match the single transform"""
+        self.test.debug("spec batched")
+        target = fft.spec(self.field1, self.d1, self.d2)
+        for kw in [dict(chunksize=1), dict(threads=2),
+                   dict(chunksize=2, threads=2, real=True)]:
+            result = fft.spec(self.field1, self.d1, self.d2, **kw)
+            self.same_spectrum(target, result)
+        target = fft.cospec(self.field1, self.field2, self.d1, self.d2)
+        result = fft.spec(self.field1, self.d1, self.d2, field2=self.field2,
+                          chunksize=1, threads=3)
+        for a, b in zip(target, result):
+            assert numpy.allclose(a, b)
+        # threads share the cached pyfftw plans, so check they still agree
+        if "pyfftw" in fft.available_backends():
+            target = fft.spec(self.field1, self.d1, self.d2)
+            for kw in [dict(chunksize=1, threads=3),
+                       dict(chunksize=1, threads=3, real=True)]:
+                result = fft.spec(self.field1, self.d1, self.d2,
+                                  backend="pyfftw", **kw)
+                self.same_spectrum(target, result)
+
+    def test_out(self):
+        """Amplitude and phase are written into the given buffers"""
+        self.test.debug("spec out")
+        target = fft.spec(self.field1, self.d1, self.d2)
+        amp = numpy.empty_like(target[0])
+        pha = numpy.empty_like(target[1])
+        result = fft.spec(self.field1, self.d1, self.d2, out=(amp, pha))
+        assert result[0] is amp and result[1] is pha
+        assert numpy.array_equal(amp, target[0])
+        assert numpy.array_equal(pha, target[1])
+
+    def test_welch(self):
+        """Segment averaged power matches a loop over the segments"""
+        self.test.debug("spec welch")
+        import scipy.signal
+        data = numpy.random.RandomState(1).rand(2, 64, 12)
+        nperseg = 16
+        window = scipy.signal.get_window("hann", nperseg)
+        power, f1, f2 = fft.spec_welch(data, self.d1, self.d2, nperseg)
+        total = 0.0
+        starts = range(0, data.shape[1] - nperseg + 1, nperseg//2)
+        for start in starts:
+            segment = scipy.signal.detrend(data[:, start:start+nperseg],
+                                           axis=1)
+            segment = segment*window[:, numpy.newaxis]
+            amp = fft.spec(segment, self.d1, self.d2)[0]
+            total = total + amp**2
+        target = total/len(starts)/numpy.mean(window**2)
+        assert power.shape == target.shape
+        assert numpy.allclose(power, target)
+        assert f1.size == nperseg
+
+    def test_cross_spectra(self):
+        """Every pair of cross_spectra matches cospec"""
+        self.test.debug("cross spectra")
+        fields = dict(a=self.field1, b=self.field2)
+        count = 0
+        for result in fft.cross_spectra(fields, self.d1, self.d2):
+            (name1, name2, cospec, quad, coherence, phase) = result[:6]
+            target = fft.cospec(fields[name1], fields[name2],
+                                self.d1, self.d2)
+            assert numpy.allclose(cospec, target[0])
+            assert numpy.allclose(quad, target[1])
+            count += 1
+        assert count == 3
+        pairs = list(fft.cross_spectra(fields, self.d1, self.d2,
+                                       average_axes=[0]))
+        coherence = pairs[1][4]
+        assert numpy.all(coherence[numpy.isfinite(coherence)] <= 1 + 1e-10)
+        # by default the segments are detrended the same as spec_welch
+        data = numpy.random.RandomState(1).rand(2, 64, 12)
+        target = fft.spec_welch(data, self.d1, self.d2, 16, axes=[1, 2],
+                                field2=data)
+        cross = next(fft.cross_spectra(dict(a=data), self.d1, self.d2,
+                                       axes=[1, 2], nperseg=16))
+        assert numpy.allclose(cross[2], target[0])
+        assert numpy.allclose(cross[3], target[1])
+
+    def test_outofcore(self):
+        """Streaming a memmap in small slabs matches the in-memory spectrum"""
+        self.test.debug("spec outofcore")
+        import tempfile
+        with tempfile.NamedTemporaryFile() as f:
+            data = numpy.memmap(f, dtype=self.field1.dtype, mode="w+",
+                                shape=self.field1.shape)
+            data[...] = self.field1
+            for kw in self.truncations:
+                target = fft.spec(self.field1, self.d1, self.d2, **kw)
+                result = fft.spec(data, self.d1, self.d2, outofcore=True,
+                                  max_memory=512, **kw)
+                self.same_spectrum(target, result)
+        # a 2d field is split along the time axis, but detrended whole
+        field = self.field1[0] + numpy.arange(8)[:, numpy.newaxis]
+        for kw in self.truncations:
+            target = fft.spec(field, self.d1, self.d2, detrend=True, **kw)
+            result = fft.spec(field, self.d1, self.d2, outofcore=True,
+                              detrend=True, max_memory=64, **kw)
+            assert numpy.allclose(result[0], target[0])
+            # the detrended mean has no meaningful phase
+            big = target[0] > 1e-10
+            assert numpy.allclose(numpy.exp(1j*result[1][big]),
+                                  numpy.exp(1j*target[1][big]))
+        try:
+            fft.spec(field, self.d1, self.d2, outofcore=True, detrned=True)
+            raise AssertionError("misspelled keyword accepted")
+        except TypeError:
+            pass
+
+    def test_single(self):
+        """Single precision pipeline keeps float32 and matches double"""
+        self.test.debug("single precision")
+        tolerance = 1e-5
+        for kw in [dict(), dict(real=True), dict(threads=2)]:
+            double = fft.spec(self.field1, self.d1, self.d2, **kw)
+            single = fft.spec(self.field1, self.d1, self.d2,
+                              dtype=numpy.float32, **kw)
+            assert single[0].dtype == numpy.float32
+            assert single[1].dtype == numpy.float32
+            error = numpy.abs(single[0] - double[0]).max()/double[0].max()
+            assert error < tolerance
+            # compare phase where the amplitude is significant
+            big = double[0] > tolerance*double[0].max()
+            phase = numpy.abs(numpy.exp(1j*single[1][big]) -
+                              numpy.exp(1j*double[1][big]))
+            assert phase.max() < 1e-3
+        single = fft.cospec(self.field1.astype(numpy.float32),
+                            self.field2.astype(numpy.float32),
+                            self.d1, self.d2)
+        double = fft.cospec(self.field1, self.field2, self.d1, self.d2)
+        assert single[0].dtype == numpy.float32
+        assert numpy.abs(single[0] - double[0]).max() < \
+            tolerance*numpy.abs(double[0]).max()
+        assert fft.spec1d(self.field1, self.d1, 2,
+                          dtype=numpy.float32)[0].dtype == numpy.float32
+        assert fft.ifftn(self.field1, [1, 2],
+                         dtype=numpy.float32).dtype == numpy.complex64
+        assert fft.fftn(self.field1, [1, 2],
+                        dtype=numpy.float32).dtype == numpy.complex64
+        # integer (e.g. packed netCDF) data is transformed in double precision
+        packed = (self.field1*1000).astype(numpy.int16)
+        double = fft.spec(packed.astype(numpy.float64), self.d1, self.d2)
+        for kw in [dict(), dict(real=True), dict(outofcore=True)]:
+            result = fft.spec(packed, self.d1, self.d2, **kw)
+            assert result[0].dtype == numpy.float64
+            assert numpy.allclose(result[0], double[0])
+        assert fft.spec1d(packed, self.d1, 2)[0].dtype == numpy.float64
+        assert fft.ifftn(packed, [1, 2]).dtype == numpy.complex128
+
+    def test_spec1d(self):
+        """spec1d over any axis matches a loop over the 1D series"""
+        self.test.debug("spec1d")
+        for axis in [0, 1, 2]:
+            amp, pha, f1 = fft.spec1d(self.field1, self.d1, axis)
+            series = numpy.moveaxis(self.field1, axis, -1)
+            for index in numpy.ndindex(series.shape[:-1]):
+                a, p, f = fft.spec1d(series[index], self.d1)
+                assert numpy.allclose(numpy.moveaxis(amp, axis, -1)[index],
+                                      a)
+            real = fft.spec1d(self.field1, self.d1, axis, real=True)
+            assert numpy.allclose(real[0], amp)
+            assert numpy.allclose(numpy.exp(1j*real[1]), numpy.exp(1j*pha))
+            out = (numpy.empty_like(amp), numpy.empty_like(pha))
+            fft.spec1d(self.field1, self.d1, axis, out=out)
+            assert numpy.array_equal(out[0], amp)
+            assert numpy.array_equal(out[1], pha)
+
+    def test_short_axis(self):
+        """Truncated axes of length 1 and 2 keep as many axis values as data"""
+        self.test.debug("short axis")
+        rs = numpy.random.RandomState(3)
+        for shape in [(3, 8, 2), (3, 2, 11), (3, 8, 1)]:
+            field = rs.rand(*shape)
+            for kw in self.truncations:
+                for real in [False, True]:
+                    amp, pha, f1, f2 = fft.spec(field, self.d1, self.d2,
+                                                real=real, **kw)
+                    assert amp.shape[1:] == (f1.size, f2.size)
+        amp, pha, f1 = fft.spec1d(rs.rand(3, 2), self.d1, 1)
+        assert amp.shape[1] == f1.size == 2
+
+    def test_negative_axes(self):
+        """Mixed sign axes give the same spectrum as positive axes"""
+        self.test.debug("negative axes")
+        for kw in self.truncations:
+            for (axes, positive) in [([0, -1], [0, 2]), ([-2, 2], [1, 2]),
+                                     ([-1, 1], [2, 1]), ([-3, 1], [0, 1])]:
+                target = fft.spec(self.field1, self.d1, self.d2,
+                                  axes=positive, **kw)
+                for real in [False, True]:
+                    result = fft.spec(self.field1, self.d1, self.d2,
+                                      axes=axes, real=real, **kw)
+                    self.same_spectrum(target, result)
+
+    def alltest(self):
+        self.test_real()
+        self.test_cospec_real()
+        self.test_backends()
+        self.test_plan_cache()
+        self.test_batched()
+        self.test_out()
+        self.test_welch()
+        self.test_cross_spectra()
+        self.test_outofcore()
+        self.test_single()
+        self.test_spec1d()
+        self.test_short_axis()
+        self.test_negative_axes()
+
+
+if __name__ == "__main__":
+    t = test_fft()
+    t.alltest()
@@ -0,0 +1,505 @@
+from dwell.testing import Testing
+import dwell.climate.gridding as gridding
+import numpy as np
+
+
+class test_gridding(object):
+    def __init__(self):
+        """Initialize variables used to test gridding library
+
+        Creates random data with two filterable columns (the bin axes)
+        and three data columns, some of which are missing.
+        """
+        self.test = Testing()
+        rs = np.random.RandomState(42)
+        self.data = rs.rand(500, 5)
+        self.data[::7, 3] = -999.
+        self.bins = [6, 4]
+        self.missing_data = [None, -999., None]
+
+    def column(self, i, **kwargs):
+        """Grid a single data column on the same bins"""
+        data = self.data[:, [0, 1, 2 + i]]
+        return gridding.grid_data(data, self.bins,
+                                  missing_data=self.missing_data[i],
+                                  **kwargs)
+
+    def test_columns(self):
+        """Gridding several columns matches gridding each column alone"""
+        self.test.debug("grid_data columns")
+        for kw in [dict(), dict(square=True), dict(sparse=True)]:
+            result = gridding.grid_data(self.data, self.bins,
+                                        missing_data=self.missing_data, **kw)
+            for i in range(3):
+                target = self.column(i, **kw)
+                for a, b in zip(result[:3], target[:3]):
+                    assert a.shape == b.shape + (3,)
+                    assert np.allclose(a[..., i], b)
+            if kw.get("sparse"):
+                assert np.array_equal(result[3], target[3])
+
+    def test_statistics(self):
+        """The mean, variance and count of each bin match a direct loop"""
+        self.test.debug("grid_data statistics")
+        m, v, c = gridding.grid_data(self.data, self.bins,
+                                     missing_data=self.missing_data)
+        edges = [np.linspace(self.data[:, k].min(), self.data[:, k].max(),
+                             b + 1) for k, b in enumerate(self.bins)]
+        i = np.clip(np.searchsorted(edges[0], self.data[:, 0],
+                                    side="right") - 1, 0, self.bins[0] - 1)
+        j = np.clip(np.searchsorted(edges[1], self.data[:, 1],
+                                    side="right") - 1, 0, self.bins[1] - 1)
+        for x in range(self.bins[0]):
+            for y in range(self.bins[1]):
+                values = self.data[(i == x) & (j == y), 3]
+                values = values[values != -999.]
+                assert c[x, y, 1] == values.size
+                if values.size:
+                    assert np.allclose(m[x, y, 1], values.mean())
+                    assert np.allclose(v[x, y, 1], values.var())
+
+    def test_all_missing(self):
+        """A column with no valid data has a mean of the missing value"""
+        self.test.debug("grid_data all missing")
+        data = self.data.copy()
+        data[:, 4] = -5.
+        m, v, c = gridding.grid_data(data, self.bins,
+                                     missing_data=[None, -999., -5.])
+        assert np.all(m[..., 2] == -5.)
+        assert np.all(c[..., 2] == 0)
+        assert np.allclose(m[..., 0], self.column(0)[0])
+
+    def test_bin_index(self):
+        """Uniform and edge bin indices match digitize, including on edges"""
+        self.test.debug("grid_data bin index")
+        for (mn, mx, nbins) in [(-180., 180., 360), (0.1, 0.7, 7),
+                                (1e5, 1e5 + 3e-6, 30), (1., 1., 4)]:
+            edges = np.linspace(mn, mx, nbins + 1)
+            x = np.concatenate([np.linspace(mn - 1, mx + 1, 1001), edges,
+                                np.nextafter(edges, np.inf),
+                                np.nextafter(edges, -np.inf),
+                                [np.nan, np.inf, -np.inf]])
+            target = np.clip(nbins - np.digitize(x, edges[::-1]),
+                             0, nbins - 1)
+            assert np.array_equal(
+                gridding.uniform_bin_index(x, mn, mx, nbins), target)
+            assert np.array_equal(
+                gridding.edge_bin_index(x, edges, nbins), target)
+            target = np.clip(edges.size - np.digitize(x, edges[::-1]),
+                             0, edges.size - 1)
+            assert np.array_equal(
+                gridding.edge_bin_index(x, edges, edges.size), target)
+
+    def test_accumulator(self):
+        """Streamed and merged chunks match gridding all the data at once"""
+        self.test.debug("grid accumulator")
+        mn = self.data.min(0)
+        mx = self.data.max(0)
+        for square in [None, True, False]:
+            target = gridding.grid_data(self.data, self.bins, square=square,
+                                        missing_data=self.missing_data)
+            acc = gridding.GridAccumulator(self.bins, mn=mn, mx=mx,
+                                           square=square,
+                                           missing_data=self.missing_data)
+            for chunk in np.array_split(self.data, 7):
+                acc.update(chunk)
+            for a, b in zip(acc.finalize(), target):
+                assert a.shape == b.shape
+                assert np.allclose(a, b)
+            first = gridding.GridAccumulator(self.bins, mn=mn, mx=mx,
+                                             square=square,
+                                             missing_data=self.missing_data)
+            second = gridding.GridAccumulator(self.bins, mn=mn, mx=mx,
+                                              square=square,
+                                              missing_data=self.missing_data)
+            first.update(self.data[:123])
+            second.update(self.data[123:])
+            for a, b in zip(first.merge(second).finalize(), target):
+                assert np.allclose(a, b)
+        # a large offset doesn't cancel the variance
+        data = np.column_stack([self.data[:, 0], 1e9 + self.data[:, 2]])
+        acc = gridding.GridAccumulator([1], mn=[0], mx=[1])
+        for chunk in np.array_split(data, 5):
+            acc.update(chunk)
+        assert np.allclose(acc.finalize()[1], self.data[:, 2].var())
+
+    def test_parallel(self):
+        """Gridding across processes matches gridding in one pass"""
+        self.test.debug("grid_data parallel")
+        target = gridding.grid_data(self.data, self.bins,
+                                    missing_data=self.missing_data)
+        for processes in [1, 2]:
+            result = gridding.grid_data_parallel(
+                self.data, self.bins, missing_data=self.missing_data,
+                processes=processes, chunksize=100)
+            for a, b in zip(result, target):
+                assert a.shape == b.shape
+                assert np.allclose(a, b)
+        target = gridding.grid_data(self.data, self.bins, square=False,
+                                    missing_data=self.missing_data)
+        result = gridding.grid_data_parallel(
+            self.data, self.bins, missing_data=self.missing_data,
+            square=False, processes=1)
+        for a, b in zip(result, target):
+            assert np.allclose(a, b)
+
+    def test_reverse_indices(self):
+        """CSR reverse indices list the data in each bin, in order"""
+        self.test.debug("grid_data reverse indices")
+        for sparse in [False, True]:
+            result = gridding.grid_data(self.data, self.bins, sparse=sparse,
+                                        reverse_indices="csr")
+            (ri, rj) = result[-2:]
+            old = gridding.grid_data(self.data, self.bins, sparse=sparse,
+                                     reverse_indices=True)[-2]
+            assert np.array_equal(ri.counts, rj)
+            assert np.array_equal(np.sort(ri.indices),
+                                  np.arange(self.data.shape[0]))
+            for index in np.ndindex(rj.shape):
+                if rj[index]:
+                    assert np.array_equal(ri[index], old[index])
+                    assert np.all(np.diff(ri[index]) > 0)
+                else:
+                    assert old[index] is None
+            assert ri[0].base is ri.indices
+
+    def test_stable(self):
+        """The variance of float32 data with a large offset doesn't cancel"""
+        self.test.debug("grid_data stable variance")
+        data = self.data[:, :3].astype(np.float32)
+        data[:, 2] += np.float32(1e5)
+        m, v, c = gridding.grid_data(data, self.bins)
+        double = data.astype(float)
+        double[:, 2] -= 1e5
+        target = gridding.grid_data(double, self.bins)
+        assert np.allclose(v, target[1], rtol=1e-4, atol=1e-8)
+        assert np.allclose(m - 1e5, target[0], atol=1e-8)
+
+    def test_reduce(self):
+        """Segment reductions match numpy on the data of each bin"""
+        self.test.debug("grid_reduce")
+        weights = np.random.RandomState(0).rand(self.data.shape[0])
+        reducers = ["count", "sum", "mean", "min", "max", "weighted_mean",
+                    "median", "percentile90"]
+        result = gridding.grid_reduce(self.data, self.bins, reducers,
+                                      weights=weights,
+                                      missing_data=self.missing_data)
+        ri = gridding.grid_data(self.data, self.bins,
+                                reverse_indices="csr")[3]
+        for index in np.ndindex(tuple(self.bins)):
+            x = self.data[ri[index], 3]
+            w = weights[ri[index]][x != -999.]
+            x = x[x != -999.]
+            target = dict(count=x.size, sum=x.sum(), mean=x.mean(),
+                          min=x.min(), max=x.max(),
+                          weighted_mean=np.average(x, weights=w),
+                          median=np.median(x),
+                          percentile90=np.percentile(x, 90))
+            for name in reducers:
+                assert np.allclose(result[name][index + (1,)], target[name])
+        result = gridding.grid_reduce(self.data[:, :3], [50, 50],
+                                      ["count", "min"])
+        assert np.all(np.isnan(result["min"][result["count"] == 0]))
+
+    def test_sparse(self):
+        """Sparse grids match grid_data, merge, and hold huge grids"""
+        self.test.debug("grid_data_sparse")
+        mn = self.data.min(0)
+        mx = self.data.max(0)
+        for square in [True, False]:
+            grid = gridding.grid_data_sparse(self.data, self.bins,
+                                             square=square,
+                                             missing_data=self.missing_data)
+            target = gridding.grid_data(self.data, self.bins, square=square,
+                                        missing_data=self.missing_data)
+            for a, b in zip(grid.todense(), target):
+                assert np.allclose(a, b)
+        grid = gridding.grid_data_sparse(self.data, self.bins,
+                                         missing_data=self.missing_data)
+        target = gridding.grid_data(self.data, self.bins,
+                                    missing_data=self.missing_data)
+        for a, b in zip(grid.todense(), target):
+            assert a.shape == b.shape
+            assert np.allclose(a, b)
+        target = gridding.grid_data(self.data, self.bins, sparse=True,
+                                    missing_data=self.missing_data)
+        assert np.array_equal(grid.index, target[3])
+        coords = np.ravel_multi_index(grid.coords, self.bins)
+        assert np.array_equal(coords, grid.index)
+        first = gridding.grid_data_sparse(self.data[:200], self.bins,
+                                          mn=mn, mx=mx,
+                                          missing_data=self.missing_data)
+        second = gridding.grid_data_sparse(self.data[200:], self.bins,
+                                           mn=mn, mx=mx,
+                                           missing_data=self.missing_data)
+        for a, b in zip(first.merge(second).statistics(), grid.statistics()):
+            assert np.allclose(a, b)
+        # 1.5e12 bins, of which at most 500 are occupied
+        grid = gridding.grid_data_sparse(self.data, [36000, 18000, 100, 24],
+                                         mn=[0] * 4, mx=[1] * 4)
+        assert len(grid) <= self.data.shape[0]
+        assert grid.count.sum() == self.data.shape[0]
+
+    def test_full_index(self):
+        """Flat indices are compact, and huge grids are indexed by axis"""
+        self.test.debug("calculate_full_index")
+        (index, bs) = gridding.calculate_full_index(self.data, self.bins)
+        assert index.dtype == np.int8
+        axes = gridding.calculate_axis_indices(self.data, self.bins)[1]
+        target = np.ravel_multi_index(list(axes), bs)
+        assert np.array_equal(index, target)
+        # axes as long as the range of the compact dtype
+        for (bins, dtype) in [([128], np.int8), ([1, 128], np.int8),
+                              ([128, 1], np.int8), ([32768], np.int16)]:
+            (index, bs) = gridding.calculate_full_index(self.data, bins)
+            assert index.dtype == dtype
+            axes = gridding.calculate_axis_indices(self.data, bins)[1]
+            assert np.array_equal(index, np.ravel_multi_index(list(axes), bs))
+            count = gridding.grid_data(self.data[:, :len(bins)], bins)[2]
+            assert count.sum() == self.data.shape[0]
+        # the compact dtype is internal, the forward index is int64
+        result = gridding.grid_data(self.data, self.bins, sparse=True)
+        assert result[3].dtype == np.int64
+        result = gridding.grid_reduce(self.data, self.bins, sparse=True)
+        assert result["forward_index"].dtype == np.int64
+        bins = [10**7] * 3
+        mn = [0] * 3
+        mx = [1] * 3
+        try:
+            gridding.calculate_full_index(self.data, bins, mn=mn, mx=mx)
+            raise AssertionError("a 1e21 bin grid can't have a flat index")
+        except OverflowError:
+            pass
+        (inverse, coords, bs) = gridding.calculate_sparse_index(
+            self.data, bins, mn=mn, mx=mx)
+        axes = np.column_stack(list(gridding.calculate_axis_indices(
+            self.data, bins, mn=mn, mx=mx)[1]))
+        assert np.array_equal(coords[inverse], axes)
+        grid = gridding.grid_data_sparse(self.data, bins, mn=mn, mx=mx,
+                                         missing_data=self.missing_data[1:])
+        assert grid.index is None
+        assert np.array_equal(np.column_stack(grid.coords), coords)
+        merged = gridding.grid_data_sparse(self.data[:200], bins, mn=mn,
+                                           mx=mx,
+                                           missing_data=self.missing_data[1:])
+        merged = merged.merge(gridding.grid_data_sparse(
+            self.data[200:], bins, mn=mn, mx=mx,
+            missing_data=self.missing_data[1:]))
+        for a, b in zip(merged.statistics(), grid.statistics()):
+            assert np.allclose(a, b, equal_nan=True)
+
+    def test_footprint(self):
+        """Footprint gridding matches gridding a copy at every stencil offset"""
+        self.test.debug("grid_footprint")
+        mn = [0, 0]
+        mx = [1, 1]
+        data = self.data[:, :4]
+        missing_data = self.missing_data[1:]
+        weights = np.linspace(1, 2, data.shape[0])
+        result = gridding.grid_footprint(data, self.bins, [0, 0], mn=mn, mx=mx,
+                                         missing_data=missing_data,
+                                         weights=weights)
+        target = gridding.grid_data(data, self.bins, mn=mn, mx=mx,
+                                    missing_data=missing_data, weights=weights)
+        for a, b in zip(result[:2], target[:2]):
+            assert np.allclose(a, b)
+        result = gridding.grid_footprint(data, self.bins, [0, 0], mn=mn, mx=mx,
+                                         missing_data=missing_data,
+                                         square=False)
+        target = gridding.grid_data(data, self.bins, mn=mn, mx=mx,
+                                    missing_data=missing_data, square=False)
+        assert np.allclose(result[1], target[1])
+        (offsets, kernel) = gridding.kernel_stencil([1, 0], kernel="gaussian")
+        assert np.isclose(kernel.sum(), 1) and kernel[1] > kernel[0]
+        result = gridding.grid_footprint(data, self.bins, [1, 0],
+                                         kernel="gaussian", mn=mn, mx=mx,
+                                         missing_data=missing_data,
+                                         periodic=[True, False])
+        #the periodic axis keeps the whole weight of every element
+        assert np.isclose(result[2][..., 1].sum(), data.shape[0])
+        copies = []
+        for offset in offsets[:, 0]:
+            copy = data.copy()
+            copy[:, 0] = np.mod(copy[:, 0] + offset / float(self.bins[0]), 1)
+            copies.append(copy)
+        target = gridding.grid_data(np.concatenate(copies), self.bins,
+                                    mn=mn, mx=mx, missing_data=missing_data,
+                                    weights=np.repeat(kernel, data.shape[0]),
+                                    periodic=[True, False])
+        for a, b in zip(result[:2], target[:2]):
+            assert np.allclose(a, b)
+        # an axis as long as the range of the compact index dtype
+        result = gridding.grid_footprint(data[:, [0, 3]], [128], [1],
+                                         missing_data=missing_data[:1])
+        assert result[0].shape == (128,)
+
+    def test_missing(self):
+        """NaN, masks and per-column missing values are left out of every bin"""
+        self.test.debug("grid_data missing values")
+        data = self.data[:, :4].copy()
+        data[::5, 2] = np.nan
+        data[::3, 3] = 0.
+        m, v, c = gridding.grid_data(data, self.bins, missing_data=[None, 0.])
+        for (column, bad) in [(2, np.isnan(data[:, 2])), (3, data[:, 3] == 0)]:
+            target = gridding.grid_data(data[~bad][:, [0, 1, column]],
+                                        self.bins, mn=data.min(0),
+                                        mx=data.max(0))
+            assert np.allclose(m[..., column - 2], target[0])
+            assert np.allclose(v[..., column - 2], target[1])
+            assert np.array_equal(c[..., column - 2], target[2])
+        single = data[:, [0, 1, 3]]
+        for a, b in zip(gridding.grid_data(single, self.bins,
+                                           missing_data=[0.]),
+                        gridding.grid_data(single, self.bins,
+                                           missing_data=0.)):
+            assert np.array_equal(a, b)
+        masked = np.ma.masked_array(data, mask=data == 0)
+        result = gridding.grid_data(masked, self.bins)
+        assert np.array_equal(result[2], c)
+        # a NaN axis value is binned, and counted without data columns
+        axes = self.data[:, :2].copy()
+        axes[::10, 1] = np.nan
+        with np.errstate(invalid="ignore"):
+            (m, v, c, ri, rj) = gridding.grid_data(axes, self.bins, mn=[0, 0],
+                                                   mx=[1, 1],
+                                                   reverse_indices=True)
+        assert c.sum() == axes.shape[0]
+        assert np.array_equal(c, rj)
+
+    def test_weights(self):
+        """Weighted statistics match numpy.average, and area means of constants"""
+        self.test.debug("grid_data weights")
+        weights = np.random.RandomState(1).rand(self.data.shape[0])
+        m, v, c = gridding.grid_data(self.data, self.bins, weights=weights,
+                                     missing_data=self.missing_data)
+        ri = gridding.grid_data(self.data, self.bins,
+                                reverse_indices="csr")[3]
+        for index in np.ndindex(tuple(self.bins)):
+            x = self.data[ri[index], 3]
+            w = weights[ri[index]][x != -999.]
+            x = x[x != -999.]
+            mean = np.average(x, weights=w)
+            assert np.allclose(m[index + (1,)], mean)
+            assert np.allclose(v[index + (1,)],
+                               np.average((x - mean)**2, weights=w))
+            assert np.allclose(c[index + (1,)], w.sum()**2/(w**2).sum())
+        same = gridding.grid_data(self.data, self.bins,
+                                  weights=lambda data: np.ones(len(data)))
+        for a, b in zip(same, gridding.grid_data(self.data, self.bins)):
+            assert np.allclose(a, b)
+        lat = np.linspace(-90, 90, 19)
+        lon = np.linspace(0, 360, 37)
+        assert np.allclose(gridding.cell_areas(lat, lon).sum(), 4*np.pi)
+        field = np.ones((18, 36, 2))
+        count = np.ones((18, 36, 2))
+        count[:9] = 0
+        field[:9] = 99.
+        assert np.allclose(gridding.area_weighted_mean(field, lat, lon,
+                                                       count=count), 1.)
+        zonal = gridding.area_weighted_mean(field, lat, lon, zonal=True)
+        assert zonal.shape == (18, 2)
+
+    def test_regrid(self):
+        """Regridding conserves the area mean, and is cached on disk"""
+        self.test.debug("regrid")
+        import tempfile
+        import os
+        lat1 = np.linspace(-90, 90, 46)
+        lon1 = np.linspace(0, 360, 91)
+        lat2 = np.linspace(90, -90, 19)
+        lon2 = np.linspace(-180, 180, 37)
+        field = np.random.RandomState(2).rand(3, 2, 45, 90)
+        cache_dir = tempfile.mkdtemp()
+        for method in ["conservative", "bilinear"]:
+            regrid = gridding.Regridder(lat1, lon1, lat2, lon2, method=method,
+                                        cache_dir=cache_dir)
+            assert np.allclose(regrid.matrix.sum(1), 1)
+            result = regrid(field)
+            assert result.shape == (3, 2, 18, 36)
+            assert np.allclose(regrid(np.ones((45, 90))), 1)
+            assert os.path.exists(regrid.cache_file)
+            for index in np.ndindex(field.shape[:2]):
+                assert np.allclose(result[index], regrid(field[index]))
+        mean1 = gridding.area_weighted_mean(field, lat1, lon1,
+                                            lat_axis=-2, lon_axis=-1)
+        regrid = gridding.Regridder(lat1, lon1, lat2, lon2,
+                                    cache_dir=cache_dir)
+        mean2 = gridding.area_weighted_mean(regrid(field), lat2, lon2,
+                                            lat_axis=-2, lon_axis=-1)
+        assert np.allclose(mean1, mean2)
+        from dwell.climate.gridding import _regrid
+        _regrid._matrices.clear()
+        cached = gridding.Regridder(lat1, lon1, lat2, lon2,
+                                    cache_dir=cache_dir)
+        assert (cached.matrix != regrid.matrix).nnz == 0
+
+    def test_climatology(self):
+        """Periodic axes wrap at the seam, and climatologies are written to NetCDF"""
+        self.test.debug("climatology")
+        import tempfile
+        import os
+        import netCDF4
+        data = np.array([[359.9, 1.], [0.1, 2.], [360., 3.], [-10., 4.]])
+        m, v, c = gridding.grid_data(data, [36], mn=[0], mx=[360],
+                                     periodic=[True])
+        assert c[0] == 2 and c[35] == 2
+        assert m[0] == 2.5 and m[35] == 2.5
+        for processes in [1, 2]:
+            result = gridding.grid_data_parallel(data, [36], mn=[0], mx=[360],
+                                                 periodic=[True],
+                                                 processes=processes)
+            for a, b in zip(result, (m, v, c)):
+                assert np.allclose(a, b)
+        result = gridding.grid_reduce(data, [36], ("count", "max"), mn=[0],
+                                      mx=[360], periodic=[True])
+        assert np.array_equal(result["count"], c)
+        assert result["max"][0] == 3 and result["max"][35] == 4
+        rs = np.random.RandomState(3)
+        data = np.column_stack([rs.uniform(-90, 90, 1000),
+                                rs.uniform(-30, 390, 1000),
+                                rs.rand(1000), rs.rand(1000)])
+        clim = gridding.Climatology(
+            [gridding.ClimatologyAxis("lat", 6, -90, 90,
+                                      units="degrees_north"),
+             gridding.ClimatologyAxis("lon", 12, 0, 360, periodic=True,
+                                      units="degrees_east")],
+            ["a", "b"])
+        chunks = np.array_split(data, 4)
+        clim.add_files(range(len(chunks)), lambda i: chunks[i])
+        wrapped = data.copy()
+        wrapped[:, 1] = np.mod(wrapped[:, 1], 360)
+        target = gridding.grid_data(wrapped, [6, 12], mn=[-90, 0],
+                                    mx=[90, 360])
+        for a, b in zip(clim.finalize(), target):
+            assert np.allclose(a, b)
+        filename = os.path.join(tempfile.mkdtemp(), "climatology.nc")
+        clim.to_netcdf(filename)
+        with netCDF4.Dataset(filename) as nc:
+            assert np.allclose(nc.variables["lon"][:],
+                               np.arange(15, 360, 30))
+            assert nc.variables["lat_bnds"].shape == (6, 2)
+            assert np.allclose(nc.variables["b"][:], target[0][..., 1])
+            assert np.allclose(nc.variables["a_count"][:], target[2][..., 0])
+
+    def alltest(self):
+        self.test_columns()
+        self.test_statistics()
+        self.test_all_missing()
+        self.test_bin_index()
+        self.test_accumulator()
+        self.test_parallel()
+        self.test_reverse_indices()
+        self.test_stable()
+        self.test_reduce()
+        self.test_sparse()
+        self.test_full_index()
+        self.test_footprint()
+        self.test_missing()
+        self.test_weights()
+        self.test_regrid()
+        self.test_climatology()
+
+
+if __name__ == "__main__":
+    t = test_gridding()
+    t.alltest()